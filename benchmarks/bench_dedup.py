@@ -0,0 +1,68 @@
+# Times DuplicateFilter.signature and claim for new and repeated content, with
+# and without near-duplicate detection, and shows that the memory it holds
+# stays flat once the number of messages grows past max_entries.
+#
+#   python -m benchmarks.bench_dedup
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from telegram_forwarder import DuplicateFilter
+
+DESTINATIONS = 20
+
+
+def make_messages(count, seed=1):
+    rng = random.Random(seed)
+    return [
+        SimpleNamespace(chat_id=-1001, raw_text=' '.join(f"word{rng.randrange(5000)}" for _ in range(30)),
+                        media=None)
+        for _ in range(count)
+    ]
+
+
+def fill(dedup, messages):
+    signatures = [dedup.signature([message]) for message in messages]
+    for i, signature in enumerate(signatures):
+        dedup.claim(i % DESTINATIONS, signature)
+    return signatures
+
+
+def run(label, messages, max_distance=0, max_entries=100000):
+    dedup = DuplicateFilter(window=3600, max_entries=max_entries, max_distance=max_distance)
+    start = time.perf_counter()
+    signatures = [dedup.signature([message]) for message in messages]
+    hashed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i, signature in enumerate(signatures):
+        dedup.claim(i % DESTINATIONS, signature)
+    fresh = time.perf_counter() - start
+
+    # The latest messages again, cross-posted by another source, so all of
+    # them duplicates
+    latest = range(len(signatures) - 1000, len(signatures))
+    reposts = [
+        dedup.signature([SimpleNamespace(chat_id=-1002, raw_text=messages[i].raw_text, media=None)]) for i in latest
+    ]
+    start = time.perf_counter()
+    skipped = sum(not dedup.claim(i % DESTINATIONS, repost) for i, repost in zip(latest, reposts))
+    repeated = time.perf_counter() - start
+
+    tracemalloc.start()
+    dedup = DuplicateFilter(window=3600, max_entries=max_entries, max_distance=max_distance)
+    fill(dedup, messages)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"{label:<34} signature {hashed / len(messages) * 1e6:6.1f} us, claim {fresh / len(messages) * 1e6:5.2f} us, "
+          f"repeat {repeated / 1000 * 1e6:5.2f} us ({skipped} skipped), {len(dedup):>6} entries, "
+          f"{held / 2 ** 20:5.1f} MiB")
+
+
+if __name__ == "__main__":
+    for count in (10000, 100000, 400000):
+        messages = make_messages(count)
+        run(f"{count:>7} messages, exact", messages)
+        run(f"{count:>7} messages, max_distance 5", messages, max_distance=5)
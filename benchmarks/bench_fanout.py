@@ -0,0 +1,53 @@
+# Fan-out of messages to many destinations through the fake client with a
+# simulated round-trip time, reporting per-destination delivery latency.
+#
+#   python -m benchmarks.bench_fanout
+import asyncio
+import os
+import statistics
+import time
+
+from benchmarks.fake_client import FakeTelegramClient
+from telegram_forwarder import TelegramForwarder
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+UNLIMITED = {'global_per_second': 0, 'per_destination_per_second': 0}
+
+
+async def run(destination_count, max_concurrent_sends, message_count=5, rate_limits=UNLIMITED):
+    client = FakeTelegramClient(latency=0.08, jitter=0.04)
+    config = {'max_concurrent_sends': max_concurrent_sends, 'rate_limits': rate_limits, 'peer_cache_path': os.devnull}
+    forwarder = TelegramForwarder(0, '', 'bench', require_approval=False, config=config, client=client)
+    rule = {'source_chat_id': -1001, 'destination_channels': list(range(destination_count))}
+
+    latencies = []
+    started = time.perf_counter()
+    for i in range(message_count):
+        message = client.make_message(rule['source_chat_id'], f"message {i}")
+        sent_before = len(client.sent)
+        received = time.perf_counter()
+        await forwarder._forward_message(message, rule)
+        latencies.extend(sent.at - received for sent in client.sent[sent_before:])
+    elapsed = time.perf_counter() - started
+    await forwarder.scheduler.stop()
+
+    print(f"{destination_count:>3} destinations, concurrency {max_concurrent_sends:>2}: "
+          f"p50 {percentile(latencies, 0.5) * 1e3:7.1f} ms, p99 {percentile(latencies, 0.99) * 1e3:7.1f} ms, "
+          f"mean {statistics.mean(latencies) * 1e3:7.1f} ms, "
+          f"{len(latencies) / elapsed:6.1f} sends/s")
+
+
+async def main():
+    for concurrency in (1, 4, 8, 20):
+        await run(20, concurrency)
+    print("with default Telegram rate limits:")
+    await run(20, 8, rate_limits={})
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
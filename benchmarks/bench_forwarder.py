@@ -0,0 +1,144 @@
+# End-to-end benchmark of forward_messages_to_channels on the fake client:
+# a burst of synthetic updates (text with entities, media, albums) goes
+# through the real handlers, filters, scheduler and sends. Reports
+# throughput, latency from injection to delivery (native forwards) and the
+# peak memory of a second, traced run, for growing rule counts and fan-out
+# sizes, then an edit storm with and without edit coalescing and a run with
+# simulated FloodWaitErrors.
+#
+#   python -m benchmarks.bench_forwarder
+#   python -m benchmarks.bench_forwarder --messages 1000 --stream updates.jsonl
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fake_client import FakeTelegramClient, load_stream, synthetic_stream
+from telegram_forwarder import TelegramForwarder
+
+SOURCES = 10
+UNLIMITED = {'global_per_second': 0, 'per_destination_per_second': 0}
+
+
+def make_rules(rule_count, fanout, forward_edits=False):
+    # Rules spread over SOURCES chats, one keyword each, so that every
+    # message of the stream matches exactly one rule
+    rules = []
+    keywords_by_chat = {}
+    for i in range(rule_count):
+        chat_id = -1000 - i % SOURCES
+        keyword = f"kw{i}z"
+        rules.append({
+            'source_chat_id': chat_id,
+            'destination_channels': [-200000 - i * fanout - d for d in range(fanout)],
+            'keywords': [keyword],
+            'forward_edits': forward_edits,
+        })
+        keywords_by_chat.setdefault(chat_id, []).append(keyword)
+    return rules, keywords_by_chat
+
+
+def expected_sends(updates, fanout, forward_edits, edit_window):
+    # A replayed edit storm falls within one coalescing window, so only one
+    # edit per edited message is sent
+    albums = {update['grouped_id'] for update in updates if update.get('grouped_id') and not update.get('edit')}
+    singles = sum(1 for update in updates if not update.get('grouped_id') and not update.get('edit'))
+    edits = [(update['chat_id'], update['id']) for update in updates if update.get('edit')] if forward_edits else []
+    return (len(albums) + singles + len(set(edits) if edit_window else edits)) * fanout
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_once(rules, updates, expected, latency, flood_rate, trace_memory, outbox, edit_window, timeout=120):
+    client = FakeTelegramClient(latency=latency, jitter=latency / 2, flood_rate=flood_rate)
+    with tempfile.TemporaryDirectory() as directory:
+        config = {
+            'max_concurrent_sends': 32,
+            'rate_limits': UNLIMITED,
+            'peer_cache_path': os.devnull,
+            'outbox': outbox,
+            'outbox_path': os.path.join(directory, 'outbox.db'),
+            'catch_up': False,
+            'album_flush_delay': 0.05,
+            'edit_coalesce_window': edit_window,
+            'config_reload_interval': 0,
+        }
+        forwarder = TelegramForwarder(0, '', 'bench', require_approval=False, config=config, client=client)
+        task = asyncio.ensure_future(forwarder.forward_messages_to_channels(rules))
+        while not client.handlers:
+            await asyncio.sleep(0.01)
+
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        await client.replay(updates, speed=0)
+        deadline = started + timeout
+        while len(client.sent) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+        if trace_memory:
+            tracemalloc.stop()
+
+        await client.disconnect()
+        await task
+    latencies = [sent.at - client.injected_at[sent.source] for sent in client.sent if sent.source]
+    return client, elapsed, latencies, peak
+
+
+async def run(label, rules, updates, fanout, forward_edits=False, latency=0.005, flood_rate=0.0, outbox=False,
+              edit_window=0.05):
+    expected = expected_sends(updates, fanout, forward_edits, edit_window)
+    client, elapsed, latencies, _ = await run_once(
+        rules, updates, expected, latency, flood_rate, False, outbox, edit_window
+    )
+    _, _, _, peak = await run_once(rules, updates, expected, latency, flood_rate, True, outbox, edit_window)
+    missing = f", {expected - len(client.sent)} sends missing" if len(client.sent) < expected else ""
+    floods = f", {client.flood_waits} flood waits" if client.flood_waits else ""
+    edits = sum(1 for sent in client.sent if sent.kind == 'edit')
+    floods += f", {edits} edits" if edits else ""
+    print(f"{label:<28} {len(updates) / elapsed:8.1f} updates/s {len(client.sent) / elapsed:8.1f} sends/s  "
+          f"latency p50 {percentile(latencies, 0.5) * 1e3:7.1f} ms p99 {percentile(latencies, 0.99) * 1e3:7.1f} ms "
+          f"mean {statistics.mean(latencies) * 1e3:7.1f} ms  peak memory {peak / 2 ** 20:6.1f} MiB{floods}{missing}")
+
+
+async def main(args):
+    if args.stream:
+        # A recorded stream is forwarded with one catch-all rule per chat
+        updates = load_stream(args.stream)
+        chats = sorted({update['chat_id'] for update in updates})
+        rules = [{'source_chat_id': chat_id, 'destination_channels': [-200000 - i], 'forward_edits': True}
+                 for i, chat_id in enumerate(chats)]
+        await run(f"{args.stream}", rules, updates, 1, forward_edits=True)
+        return
+
+    for rule_count in (10, 100, 1000):
+        for fanout in (1, 5, 20):
+            rules, keywords = make_rules(rule_count, fanout)
+            updates = synthetic_stream(keywords, args.messages)
+            await run(f"{rule_count:>5} rules, fan-out {fanout:>2}", rules, updates, fanout)
+
+    rules, keywords = make_rules(100, 5, forward_edits=True)
+    updates = synthetic_stream(keywords, args.messages, edit_ratio=0.2, edit_storm=15)
+    await run("edit storm (20% x 15 edits)", rules, updates, 5, forward_edits=True)
+    await run("edit storm, no coalescing", rules, updates, 5, forward_edits=True, edit_window=0)
+
+    rules, keywords = make_rules(100, 5)
+    updates = synthetic_stream(keywords, args.messages)
+    await run("1% flood waits of 1s", rules, updates, 5, flood_rate=0.01)
+    await run("with the outbox", rules, updates, 5, outbox=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end forwarder benchmark on a fake Telegram client.")
+    parser.add_argument('--messages', type=int, default=300, help="synthetic messages per run (default: 300)")
+    parser.add_argument('--stream', help="replay a recorded JSON lines stream instead")
+    logging.basicConfig(level=logging.CRITICAL)
+    asyncio.run(main(parser.parse_args()))
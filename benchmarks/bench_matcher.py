@@ -0,0 +1,53 @@
+# Compares the shared keyword alternation of SourceMatcher with checking each
+# rule's keywords separately, for growing numbers of keyword-heavy rules.
+#
+#   python -m benchmarks.bench_matcher
+import random
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telegram_forwarder import RuleMatcher, SourceMatcher
+
+WORDS = [f"word{i}" for i in range(5000)]
+
+
+def make_rules(rule_count, keywords_per_rule, rng):
+    return [{
+        'source_chat_id': -1001,
+        'destination_channels': [-2000 - i],
+        'keywords': rng.sample(WORDS, keywords_per_rule),
+    } for i in range(rule_count)]
+
+
+def make_messages(message_count, rng):
+    date = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+    return [SimpleNamespace(raw_text=' '.join(rng.choices(WORDS, k=60)), date=date)
+            for _ in range(message_count)]
+
+
+def run(rule_count, keywords_per_rule=20, message_count=200):
+    rng = random.Random(7)
+    rules = make_rules(rule_count, keywords_per_rule, rng)
+    messages = make_messages(message_count, rng)
+
+    matchers = [RuleMatcher(rule) for rule in rules]
+    start = time.perf_counter()
+    for message in messages:
+        [m.rule for m in matchers if m.matches(message.raw_text, message.date.time())]
+    per_rule = time.perf_counter() - start
+
+    source_matcher = SourceMatcher(rules)
+    start = time.perf_counter()
+    for message in messages:
+        source_matcher.match(message)
+    shared = time.perf_counter() - start
+
+    print(f"{rule_count:>5} rules x {keywords_per_rule} keywords: "
+          f"per-rule {per_rule / message_count * 1e6:9.1f} us/message, "
+          f"shared {shared / message_count * 1e6:8.1f} us/message")
+
+
+if __name__ == "__main__":
+    for rule_count in (10, 100, 1000):
+        run(rule_count)
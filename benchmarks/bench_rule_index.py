@@ -0,0 +1,65 @@
+# Replays synthetic updates against the compiled rule index and against the
+# old linear scan over every rule.
+#
+#   python -m benchmarks.bench_rule_index
+import random
+import time
+
+from telegram_forwarder import RuleIndex
+
+
+def make_rules(rule_count, source_count):
+    rules = []
+    for i in range(rule_count):
+        rules.append({
+            'source_chat_id': -1000000000000 - (i % source_count),
+            'destination_channels': [-2000000000000 - i],
+            'forward_edits': i % 4 == 0,
+        })
+    return rules
+
+
+def make_updates(update_count, source_count, miss_ratio=0.5):
+    rng = random.Random(42)
+    updates = []
+    for _ in range(update_count):
+        if rng.random() < miss_ratio:
+            # Chats without any rule, e.g. private dialogs
+            updates.append(rng.randint(1, 10 ** 9))
+        else:
+            updates.append(-1000000000000 - rng.randrange(source_count))
+    return updates
+
+
+def linear_scan(rules, chat_id):
+    return [rule for rule in rules if rule['source_chat_id'] == chat_id]
+
+
+def run(rule_count, update_count=20000):
+    source_count = max(1, rule_count // 5)
+    rules = make_rules(rule_count, source_count)
+    updates = make_updates(update_count, source_count)
+
+    start = time.perf_counter()
+    for chat_id in updates:
+        linear_scan(rules, chat_id)
+    linear = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = RuleIndex(rules)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for chat_id in updates:
+        for _ in index.rules_for(chat_id):
+            pass
+    indexed = time.perf_counter() - start
+
+    print(f"{rule_count:>6} rules: linear {linear / update_count * 1e6:9.2f} us/update, "
+          f"indexed {indexed / update_count * 1e6:6.2f} us/update, "
+          f"index build {build * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    for rule_count in (1000, 10000):
+        run(rule_count)
@@ -0,0 +1,76 @@
+# Compares the slicing preview the forwarder used to build (one copy of the
+# text per entity) with the single-pass preview, and times the TextPipeline
+# (link removal, prefix and suffix, entity offsets) for growing numbers of
+# entities.
+#
+#   python -m benchmarks.bench_text
+import time
+
+from telethon.tl.types import MessageEntityBold, MessageEntityItalic, MessageEntityTextUrl
+
+from telegram_forwarder import FormattedText, TextPipeline
+
+RULE = {'remove_links': True, 'prefix': '>> ', 'suffix': ' <<'}
+
+
+def make_message(entity_count):
+    words = []
+    entities = []
+    offset = 0
+    for i in range(entity_count):
+        word = f"word{i} "
+        if i % 3 == 0:
+            entities.append(MessageEntityBold(offset, len(word) - 1))
+        elif i % 3 == 1:
+            entities.append(MessageEntityItalic(offset, len(word) - 1))
+        else:
+            entities.append(MessageEntityTextUrl(offset, len(word) - 1, f"https://example.com/{i}"))
+        words.append(word)
+        offset += len(word)
+        if i % 10 == 9:
+            link = "https://example.com/page "
+            words.append(link)
+            offset += len(link)
+    return ''.join(words), entities
+
+
+def slicing_preview(text, entities):
+    preview = text
+    for entity in entities:
+        start = entity.offset
+        end = entity.offset + entity.length
+        if isinstance(entity, MessageEntityTextUrl):
+            preview = preview[:start] + f"[{preview[start:end]}]({entity.url})" + preview[end:]
+        elif isinstance(entity, MessageEntityBold):
+            preview = preview[:start] + f"**{preview[start:end]}**" + preview[end:]
+        elif isinstance(entity, MessageEntityItalic):
+            preview = preview[:start] + f"*{preview[start:end]}*" + preview[end:]
+    return preview
+
+
+def run(entity_count, repeat=20):
+    text, entities = make_message(entity_count)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        slicing_preview(text, entities)
+    slicing = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        FormattedText(text, entities).preview()
+    single_pass = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    pipeline = TextPipeline(RULE)
+    for _ in range(repeat):
+        pipeline.frame(pipeline.apply(text, entities))
+    pipeline = (time.perf_counter() - start) / repeat
+
+    print(f"{entity_count:>6} entities: slicing preview {slicing * 1e3:8.2f} ms, "
+          f"single-pass preview {single_pass * 1e3:7.2f} ms, pipeline {pipeline * 1e3:7.2f} ms")
+
+
+if __name__ == "__main__":
+    for entity_count in (10, 100, 1000, 10000):
+        run(entity_count)
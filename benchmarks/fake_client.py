@@ -0,0 +1,295 @@
+# In-memory stand-in for telethon.TelegramClient, for running the forwarder
+# without a Telegram account. It implements the client methods the forwarder
+# calls, injects NewMessage/MessageEdited updates into the registered
+# handlers, simulates send latency and FloodWaitErrors, and records every
+# outgoing request.
+#
+#   client = FakeTelegramClient(latency=0.01)
+#   forwarder = TelegramForwarder(0, '', 'bench', require_approval=False, config=config, client=client)
+#   task = asyncio.ensure_future(forwarder.forward_messages_to_channels(rules))
+#   await client.inject(client.make_message(-1001, "hello"))
+#
+# Recorded streams are JSON lines, one update per line:
+#
+#   {"chat_id": -1001, "id": 7, "text": "hello", "entities": [{"type": "bold", "offset": 0, "length": 5}],
+#    "media": "photo", "grouped_id": 42, "edit": false, "delay": 0.1}
+import asyncio
+import itertools
+import json
+import random
+import time
+from datetime import datetime, timezone
+
+from telethon import events
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (
+    InputPeerChannel, MessageEntityBold, MessageEntityItalic, MessageEntityTextUrl, MessageEntityUrl,
+    MessageMediaPhoto, Photo
+)
+
+ENTITY_TYPES = {
+    'bold': MessageEntityBold,
+    'italic': MessageEntityItalic,
+    'url': MessageEntityUrl,
+    'text_url': MessageEntityTextUrl,
+}
+
+
+class FakeMessage:
+    __slots__ = ('id', 'chat_id', 'raw_text', 'entities', 'media', 'grouped_id', 'date', 'edit_date')
+
+    def __init__(self, id, chat_id, raw_text='', entities=None, media=None, grouped_id=None, date=None,
+                 edit_date=None):
+        self.id = id
+        self.chat_id = chat_id
+        self.raw_text = raw_text
+        self.entities = entities
+        self.media = media
+        self.grouped_id = grouped_id
+        self.date = date or datetime.now(timezone.utc)
+        self.edit_date = edit_date
+
+    @property
+    def text(self):
+        return self.raw_text
+
+
+class FakeEvent:
+    __slots__ = ('chat_id', 'message')
+
+    def __init__(self, message):
+        self.chat_id = message.chat_id
+        self.message = message
+
+
+class FakeDialog:
+    def __init__(self, peer_id, input_entity):
+        self.id = peer_id
+        self.input_entity = input_entity
+
+
+class SentRequest:
+    # source is the (chat_id, message_id) of the first forwarded message, for
+    # native forwards only; entities are the formatting_entities of the text
+    __slots__ = ('kind', 'chat_id', 'payload', 'source', 'at', 'entities')
+
+    def __init__(self, kind, chat_id, payload, source, at, entities=None):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.payload = payload
+        self.source = source
+        self.at = at
+        self.entities = entities
+
+
+def make_entity(entity):
+    entity_type = ENTITY_TYPES[entity['type']]
+    if entity_type is MessageEntityTextUrl:
+        return entity_type(entity['offset'], entity['length'], entity['url'])
+    return entity_type(entity['offset'], entity['length'])
+
+
+class FakeTelegramClient:
+    # Sends take latency +/- jitter seconds. Each send raises a FloodWaitError
+    # of flood_seconds with probability flood_rate, without being recorded.
+    def __init__(self, session=None, api_id=None, api_hash=None, latency=0.01, jitter=0.0, flood_rate=0.0,
+                 flood_seconds=1, seed=1):
+        self.session = session
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rng = random.Random(seed)
+        self.flood_sleep_threshold = 60
+        self.handlers = []
+        self.messages = {}
+        self.sent = []
+        self.flood_waits = 0
+        self.message_ids = itertools.count(1)
+        self.sent_ids = itertools.count(1)
+        self.tasks = set()
+        self.injected_at = {}
+        self.chat_ids = {}
+        self.disconnected = None
+
+    def input_peer(self, chat_id):
+        channel_id = abs(chat_id) % 10 ** 12
+        self.chat_ids[channel_id] = chat_id
+        return InputPeerChannel(channel_id, 1)
+
+    def chat_id(self, peer):
+        # Peers cached by an earlier client map back to negative chat IDs
+        return self.chat_ids.get(peer.channel_id, -peer.channel_id)
+
+    # Session
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        if self.disconnected is not None and not self.disconnected.done():
+            self.disconnected.set_result(None)
+
+    async def is_user_authorized(self):
+        return True
+
+    async def run_until_disconnected(self):
+        self.disconnected = asyncio.get_running_loop().create_future()
+        await self.disconnected
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self.handlers = [(cb, ev) for cb, ev in self.handlers if cb is not callback]
+
+    # Updates
+
+    def make_message(self, chat_id, text='', entities=None, media=None, grouped_id=None, id=None):
+        message = FakeMessage(next(self.message_ids) if id is None else id, chat_id, text, entities, media, grouped_id)
+        self.messages[(chat_id, message.id)] = message
+        return message
+
+    @staticmethod
+    def make_photo(photo_id):
+        return MessageMediaPhoto(photo=Photo(photo_id, photo_id, b'', datetime.now(timezone.utc), [], 1))
+
+    def make_edit(self, message, text):
+        edited = FakeMessage(message.id, message.chat_id, text, message.entities, message.media, message.grouped_id,
+                             message.date, datetime.now(timezone.utc))
+        self.messages[(message.chat_id, message.id)] = edited
+        return edited
+
+    async def inject(self, message, edit=False):
+        # Like Telethon, every handler runs in its own task
+        builder_type = events.MessageEdited if edit else events.NewMessage
+        event = FakeEvent(message)
+        self.injected_at.setdefault((message.chat_id, message.id), time.perf_counter())
+        for callback, builder in self.handlers:
+            if type(builder) is not builder_type:
+                continue
+            if builder.func is not None and not builder.func(event):
+                continue
+            task = asyncio.ensure_future(callback(event))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def drain(self):
+        # Waits until every injected update has been handled
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    async def replay(self, updates, speed=1.0):
+        # Injects updates read by load_stream, honouring their delays
+        for update in updates:
+            if update.get('delay') and speed:
+                await asyncio.sleep(update['delay'] / speed)
+            entities = [make_entity(entity) for entity in update.get('entities', [])]
+            media = self.make_photo(update['id']) if update.get('media') else None
+            if update.get('edit'):
+                original = self.messages.get((update['chat_id'], update['id']))
+                if original is None:
+                    original = self.make_message(update['chat_id'], '', entities, media, update.get('grouped_id'),
+                                                 update['id'])
+                message = self.make_edit(original, update.get('text', ''))
+            else:
+                message = self.make_message(update['chat_id'], update.get('text', ''), entities, media,
+                                            update.get('grouped_id'), update['id'])
+            await self.inject(message, edit=update.get('edit', False))
+
+    # Requests
+
+    async def get_input_entity(self, peer):
+        return self.input_peer(peer)
+
+    async def iter_dialogs(self):
+        for chat_id in sorted({chat_id for chat_id, _ in self.messages}):
+            yield FakeDialog(chat_id, self.input_peer(chat_id))
+
+    async def get_messages(self, peer, ids=None, limit=None, **kwargs):
+        chat_id = self.chat_id(peer)
+        if ids is not None:
+            return [self.messages.get((chat_id, message_id)) for message_id in ids]
+        found = sorted((m for (c, _), m in self.messages.items() if c == chat_id), key=lambda m: m.id, reverse=True)
+        return found[:limit] if limit else found
+
+    async def iter_messages(self, peer, min_id=0, max_id=0, reverse=False, **kwargs):
+        for message in sorted(await self.get_messages(peer), key=lambda m: m.id, reverse=not reverse):
+            if message.id > min_id and (not max_id or message.id < max_id):
+                yield message
+
+    async def _request(self, kind, peer, payload, source=None, count=1, ids=None, entities=None):
+        delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        chat_id = self.chat_id(peer)
+        self.sent.append(SentRequest(kind, chat_id, payload, source, time.perf_counter(), entities))
+        ids = ids or [next(self.sent_ids) for _ in range(count)]
+        return [FakeMessage(message_id, chat_id, str(payload)) for message_id in ids]
+
+    async def send_message(self, peer, message, formatting_entities=None, **kwargs):
+        return (await self._request('message', peer, message, entities=formatting_entities))[0]
+
+    async def send_file(self, peer, file, caption=None, formatting_entities=None, **kwargs):
+        if isinstance(file, list):
+            return await self._request('album', peer, caption, count=len(file), entities=formatting_entities)
+        return (await self._request('file', peer, caption, entities=formatting_entities))[0]
+
+    async def forward_messages(self, peer, messages, from_peer=None, **kwargs):
+        source = (self.chat_id(from_peer), messages[0]) if from_peer is not None else None
+        return await self._request('forward', peer, messages, source, len(messages))
+
+    async def edit_message(self, peer, message, text=None, formatting_entities=None, **kwargs):
+        message_id = message if isinstance(message, int) else message.id
+        return (await self._request('edit', peer, text, ids=[message_id], entities=formatting_entities))[0]
+
+    async def delete_messages(self, peer, message_ids, **kwargs):
+        await self._request('delete', peer, message_ids)
+
+
+def load_stream(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def synthetic_stream(keywords_by_chat, count, media_ratio=0.2, album_ratio=0.1, entity_count=3, edit_ratio=0.0,
+                     edit_storm=1, seed=1):
+    # Updates in the load_stream format for the chats of keywords_by_chat,
+    # each text carrying one of its chat's keywords (if any) and some
+    # entities: plain messages, single media, albums of three, and edits,
+    # edit_storm of them per edited message as live-updated posts do
+    rng = random.Random(seed)
+    chat_ids = sorted(keywords_by_chat)
+    updates = []
+    message_id = 0
+    grouped_id = 0
+    for _ in range(count):
+        chat_id = rng.choice(chat_ids)
+        words = [f"word{rng.randrange(1000)}" for _ in range(20)]
+        if keywords_by_chat[chat_id]:
+            words[rng.randrange(len(words))] = rng.choice(keywords_by_chat[chat_id])
+        text = ' '.join(words)
+        entities = []
+        for _ in range(entity_count):
+            offset = rng.randrange(len(text) - 5)
+            entities.append({'type': rng.choice(['bold', 'italic']), 'offset': offset, 'length': 5})
+        entities.sort(key=lambda entity: entity['offset'])
+        kind = rng.random()
+        if kind < album_ratio:
+            grouped_id += 1
+            for item in range(3):
+                message_id += 1
+                updates.append({'chat_id': chat_id, 'id': message_id, 'text': text if item == 0 else '',
+                                'entities': entities if item == 0 else [], 'media': 'photo', 'grouped_id': grouped_id})
+            continue
+        message_id += 1
+        updates.append({'chat_id': chat_id, 'id': message_id, 'text': text, 'entities': entities,
+                        'media': 'photo' if kind < album_ratio + media_ratio else None})
+        if rng.random() < edit_ratio:
+            for version in range(edit_storm):
+                updates.append({'chat_id': chat_id, 'id': message_id, 'text': f"{text} (update {version + 1})",
+                                'edit': True})
+    return updates
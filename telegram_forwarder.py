@@ -1,30 +1,1680 @@
 import time
+import argparse
 import asyncio
+import bisect
+import contextlib
+import csv
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import queue
+import sys
 import logging
 import re
-from telethon import TelegramClient, events
-from telethon.errors import FloodWaitError
+import signal
+from telethon import TelegramClient, events, utils
+from telethon.helpers import add_surrogate, del_surrogate
+from telethon.errors import (
+    ChannelInvalidError, ChannelPrivateError, ChatForwardsRestrictedError, FloodWaitError, MessageAuthorRequiredError,
+    MessageEditTimeExpiredError, MessageIdInvalidError, MessageNotModifiedError, PeerIdInvalidError
+)
 import json
 from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
 import os
+import sqlite3
+from collections import OrderedDict
+from types import SimpleNamespace
 from telethon import functions
-from telethon.tl.types import MessageEntityTextUrl
-from prompt_toolkit import prompt
+from telethon.tl.types import (
+    InputPeerChannel, InputPeerChat, InputPeerSelf, InputPeerUser, MessageEntityBold, MessageEntityItalic,
+    MessageEntityMentionName, MessageEntityTextUrl, MessageEntityUrl
+)
+from prompt_toolkit import prompt, PromptSession
 from prompt_toolkit.completion import WordCompleter
 from prompt_toolkit.styles import Style
 from prompt_toolkit.validation import Validator, ValidationError
 
+CONFIG_PATH = "config.json"
+
+URL_PATTERN = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+WORD_PATTERN = re.compile(r'\w+')
+
+def keyword_trie_pattern(keywords):
+    # Alternation shaped as a trie so that the regex engine tries each
+    # character once per position instead of once per keyword. Optional
+    # groups are greedy, so the longest keyword at a position wins.
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{pattern})?' if '' in node else pattern
+
+    return build(trie)
+
+def parse_time_of_day(value):
+    return datetime.strptime(value.strip(), "%H:%M").time()
+
+def rule_key(rule):
+    # Rules have no ID, a rule is identified by its whole content
+    return json.dumps(rule, sort_keys=True)
+
+def validate_rules(forward_rules):
+    # Raises ValueError describing the first invalid rule
+    def is_chat_id(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    if not isinstance(forward_rules, list):
+        raise ValueError('"forward_rules" must be a list')
+    for number, rule in enumerate(forward_rules, 1):
+        if not isinstance(rule, dict):
+            raise ValueError(f"Rule {number} is not an object")
+        if not is_chat_id(rule.get('source_chat_id')):
+            raise ValueError(f"Rule {number}: source_chat_id must be a chat ID")
+        destinations = rule.get('destination_channels')
+        if not isinstance(destinations, list) or not destinations or not all(map(is_chat_id, destinations)):
+            raise ValueError(f"Rule {number}: destination_channels must be a non-empty list of chat IDs")
+        keywords = rule.get('keywords') or []
+        if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+            raise ValueError(f"Rule {number}: keywords must be a list of strings")
+        try:
+            RuleMatcher(rule)
+            if rule.get('schedule'):
+                parse_time_of_day(rule['schedule'])
+        except (re.error, ValueError, KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Rule {number}: {e}") from e
+
+def rule_label(rule):
+    # Rules can be given a "name" for metrics, otherwise they are labelled by
+    # their source chat
+    return rule.get('name') or str(rule['source_chat_id'])
+
+class RuleMatcher:
+    # Keywords, regex_pattern and time_range of a single rule, compiled once,
+    # along with the text pipeline of the rule.
+    def __init__(self, rule):
+        self.rule = rule
+        self.pipeline = TextPipeline(rule)
+        self.keywords = frozenset(
+            keyword.strip().lower() for keyword in rule.get('keywords') or [] if keyword and keyword.strip()
+        )
+        regex_pattern = rule.get('regex_pattern')
+        self.regex = re.compile(regex_pattern) if regex_pattern else None
+        time_range = rule.get('time_range')
+        if time_range:
+            self.start_time = parse_time_of_day(time_range['start'])
+            self.end_time = parse_time_of_day(time_range['end'])
+        else:
+            self.start_time = self.end_time = None
+
+    def in_time_range(self, message_time):
+        if self.start_time is None:
+            return True
+        if self.start_time <= self.end_time:
+            return self.start_time <= message_time <= self.end_time
+        # Ranges such as 22:00-06:00 wrap around midnight
+        return message_time >= self.start_time or message_time <= self.end_time
+
+    def matches_keywords(self, text):
+        if not self.keywords:
+            return True
+        lowered = text.lower()
+        return any(keyword in lowered for keyword in self.keywords)
+
+    def matches_filters(self, text, message_time):
+        if self.regex is not None and not self.regex.search(text):
+            return False
+        return self.in_time_range(message_time)
+
+    def matches(self, text, message_time):
+        return self.matches_keywords(text) and self.matches_filters(text, message_time)
+
+class SourceMatcher:
+    # The rules of one source share a single keyword automaton, so a message
+    # is scanned once however many rules and keywords there are.
+    def __init__(self, rules, key=None):
+        self.key = key
+        self.matchers = [RuleMatcher(rule) for rule in rules]
+        self.unconditional = [i for i, matcher in enumerate(self.matchers) if not matcher.keywords]
+        rules_by_keyword = {}
+        for i, matcher in enumerate(self.matchers):
+            for keyword in matcher.keywords:
+                rules_by_keyword.setdefault(keyword, set()).add(i)
+        if rules_by_keyword:
+            self.keyword_regex = re.compile(f'(?=({keyword_trie_pattern(rules_by_keyword)}))')
+            # The automaton only reports the longest keyword at each position,
+            # so it also stands for every keyword contained in it
+            self.rules_by_keyword = {}
+            for keyword in rules_by_keyword:
+                indexes = set()
+                for start in range(len(keyword)):
+                    for end in range(start + 1, len(keyword) + 1):
+                        indexes.update(rules_by_keyword.get(keyword[start:end], ()))
+                self.rules_by_keyword[keyword] = indexes
+        else:
+            self.keyword_regex = None
+            self.rules_by_keyword = {}
+
+    def candidates(self, text):
+        if self.keyword_regex is None:
+            return self.unconditional
+        seen = set()
+        candidates = set(self.unconditional)
+        for match in self.keyword_regex.finditer(text.lower()):
+            keyword = match.group(1)
+            if keyword not in seen:
+                seen.add(keyword)
+                candidates |= self.rules_by_keyword[keyword]
+        return sorted(candidates)
+
+    def match(self, message):
+        text = message.raw_text or ''
+        message_time = message.date.time()
+        return [
+            self.matchers[i].rule for i in self.candidates(text)
+            if self.matchers[i].matches_filters(text, message_time)
+        ]
+
+class RuleIndex:
+    # Forwarding rules grouped by source chat, compiled once so that each
+    # update costs a dict lookup instead of a scan over every rule. When built
+    # from a previous index, the sources whose rules did not change keep their
+    # compiled matchers.
+    def __init__(self, forward_rules, previous=None):
+        self.rules = list(forward_rules)
+        self.by_source = {}
+        self.edits_by_source = {}
+        for rule in self.rules:
+            source_chat_id = rule['source_chat_id']
+            self.by_source.setdefault(source_chat_id, []).append(rule)
+            if rule.get('forward_edits', False):
+                self.edits_by_source.setdefault(source_chat_id, []).append(rule)
+        self.recompiled = 0
+        self.matchers = {
+            source: self._compile(rules, previous and previous.matchers.get(source))
+            for source, rules in self.by_source.items()
+        }
+        self.edit_matchers = {
+            source: self._compile(rules, previous and previous.edit_matchers.get(source))
+            for source, rules in self.edits_by_source.items()
+        }
+        # Matched rules are the ones held by the matchers, which may have been
+        # kept from the previous index
+        self.pipelines = {
+            id(matcher.rule): matcher.pipeline
+            for source_matchers in (self.matchers, self.edit_matchers)
+            for source_matcher in source_matchers.values() for matcher in source_matcher.matchers
+        }
+
+    def _compile(self, rules, previous):
+        key = tuple(rule_key(rule) for rule in rules)
+        if previous is not None and previous.key == key:
+            return previous
+        self.recompiled += 1
+        return SourceMatcher(rules, key)
+
+    @property
+    def sources(self):
+        return list(self.by_source)
+
+    def rules_for(self, chat_id):
+        return self.by_source.get(chat_id, ())
+
+    def pipeline(self, rule):
+        # Rules of an older index (a send in progress during a reload) or
+        # read from the config get a pipeline of their own
+        pipeline = self.pipelines.get(id(rule))
+        return pipeline if pipeline is not None else TextPipeline(rule)
+
+    def match(self, chat_id, message):
+        matcher = self.matchers.get(chat_id)
+        return matcher.match(message) if matcher else []
+
+    def match_edit(self, chat_id, message):
+        matcher = self.edit_matchers.get(chat_id)
+        return matcher.match(message) if matcher else []
+
+def shift_entity(entity, offset, length):
+    moved = object.__new__(type(entity))
+    moved.__dict__.update(entity.__dict__)
+    moved.offset = offset
+    moved.length = length
+    return moved
+
+def has_surrogates(text):
+    # Whether the text has characters outside the BMP, which count as two
+    # UTF-16 code units
+    return not text.isascii() and len(text.encode('utf-16-le')) != 2 * len(text)
+
+def utf16_len(text):
+    return len(text) if text.isascii() else len(text.encode('utf-16-le')) // 2
+
+class FormattedText:
+    # Text with its formatting entities. Offsets are in UTF-16 code units, as
+    # Telegram counts them.
+    __slots__ = ('text', 'entities')
+
+    def __init__(self, text='', entities=None):
+        self.text = text
+        self.entities = entities or []
+
+    def __bool__(self):
+        return bool(self.text)
+
+    def __str__(self):
+        return self.text
+
+    @classmethod
+    def join(cls, parts, separator='\n'):
+        texts = []
+        entities = []
+        offset = 0
+        for i, part in enumerate(parts):
+            if i:
+                texts.append(separator)
+                offset += utf16_len(separator)
+            entities.extend(shift_entity(entity, entity.offset + offset, entity.length) for entity in part.entities)
+            texts.append(part.text)
+            offset += utf16_len(part.text)
+        return cls(''.join(texts), entities)
+
+    def preview(self):
+        # Markdown-like rendering for the approval prompt, built in one pass
+        # over the text with the entity markers sorted by position
+        markers = []
+        for entity in self.entities:
+            if isinstance(entity, MessageEntityTextUrl):
+                opening, closing = '[', f"]({entity.url})"
+            elif isinstance(entity, MessageEntityBold):
+                opening = closing = '**'
+            elif isinstance(entity, MessageEntityItalic):
+                opening = closing = '*'
+            else:
+                continue
+            end = entity.offset + entity.length
+            # At the same position, closing markers go first, and outer
+            # entities open before and close after inner ones
+            markers.append((entity.offset, 1, -end, opening))
+            markers.append((end, 0, -entity.offset, closing))
+        markers.sort()
+        surrogates = has_surrogates(self.text)
+        text = add_surrogate(self.text) if surrogates else self.text
+        parts = []
+        position = 0
+        for offset, _, _, marker in markers:
+            parts.append(text[position:offset])
+            parts.append(marker)
+            position = offset
+        parts.append(text[position:])
+        return del_surrogate(''.join(parts)) if surrogates else ''.join(parts)
+
+class RemoveLinks:
+    # Deletes URLs from the text, and the hidden links behind words
+    def __init__(self, rule):
+        pass
+
+    def edits(self, text):
+        return [(match.start(), match.end(), '') for match in URL_PATTERN.finditer(text)]
+
+    def keep(self, entity):
+        return not isinstance(entity, (MessageEntityUrl, MessageEntityTextUrl))
+
+# Text transforms, each enabled by the rule key it is registered under. A
+# transform returns (start, end, replacement) edits against the original text
+# and may drop entities; it never sees the output of the other transforms.
+TEXT_TRANSFORMS = {
+    'remove_links': RemoveLinks,
+}
+
+# Entities that cannot be sent back as they were received
+UNSENDABLE_ENTITIES = (MessageEntityMentionName,)
+
+class TextPipeline:
+    # Rewrites the text of a message for a rule. The edits of every transform
+    # are applied in a single pass over the text, and each entity is moved
+    # with a binary search over the edits instead of re-slicing the text, so a
+    # message costs O(text + entities * log edits).
+    def __init__(self, rule):
+        self.prefix = rule.get('prefix', '')
+        self.suffix = rule.get('suffix', '')
+        self.transforms = [transform(rule) for key, transform in TEXT_TRANSFORMS.items() if rule.get(key)]
+
+    def apply(self, text, entities=None):
+        # Works on surrogate pairs so that string indexes are UTF-16 offsets
+        text = text or ''
+        surrogates = has_surrogates(text)
+        if surrogates:
+            text = add_surrogate(text)
+        edits = sorted(edit for transform in self.transforms for edit in transform.edits(text))
+
+        parts = []
+        starts, ends, new_starts, replaced_lengths, shifts = [], [], [], [], []
+        position = 0
+        shift = 0
+        for start, end, replacement in edits:
+            if start < position:
+                # Overlaps an earlier edit
+                continue
+            parts.append(text[position:start])
+            parts.append(replacement)
+            starts.append(start)
+            ends.append(end)
+            new_starts.append(start + shift)
+            replaced_lengths.append(len(replacement))
+            shift += len(replacement) - (end - start)
+            shifts.append(shift)
+            position = end
+        parts.append(text[position:])
+        body = ''.join(parts)
+        stripped = body.strip()
+        # Entities move by the stripped whitespace
+        lead = len(body) - len(body.lstrip())
+
+        def move(offset, closing):
+            if closing:
+                # Text inserted right at the end of an entity stays outside it
+                i = bisect.bisect_left(ends, offset)
+                while i < len(ends) and ends[i] == offset and starts[i] < offset:
+                    i += 1
+            else:
+                i = bisect.bisect_right(ends, offset)
+            if i < len(ends) and starts[i] < offset:
+                # Inside replaced text: clip the entity to the replacement
+                return new_starts[i] if closing else new_starts[i] + replaced_lengths[i]
+            return offset + (shifts[i - 1] if i else 0)
+
+        moved = []
+        for entity in entities or ():
+            if isinstance(entity, UNSENDABLE_ENTITIES) or not all(t.keep(entity) for t in self.transforms):
+                continue
+            start = max(move(entity.offset, False) - lead, 0)
+            end = min(move(entity.offset + entity.length, True) - lead, len(stripped))
+            if end > start:
+                moved.append(shift_entity(entity, start, end - start))
+        if surrogates:
+            stripped = del_surrogate(stripped)
+        return FormattedText(stripped, moved)
+
+    def frame(self, formatted):
+        # Adds the rule's prefix and suffix as plain text. The entities are
+        # the fresh copies made by apply, so they are moved in place.
+        if not (self.prefix or self.suffix):
+            return formatted
+        offset = utf16_len(self.prefix)
+        for entity in formatted.entities:
+            entity.offset += offset
+        return FormattedText(f"{self.prefix}{formatted.text}{self.suffix}", formatted.entities)
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    # Counters and histograms kept in memory and rendered in the Prometheus
+    # text format. Series are keyed by name and labels, so recording one costs
+    # a dict lookup and an addition.
+    PREFIX = 'telegram_forwarder_'
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 3600)
+    HELP = {
+        'messages_received_total': "New messages received from source chats",
+        'edits_received_total': "Message edits received from source chats",
+        'messages_matched_total': "Messages that matched a rule",
+        'messages_forwarded_total': "Messages delivered to a destination",
+        'messages_failed_total': "Messages that could not be delivered to a destination",
+        'flood_waits_total': "FloodWaitErrors returned by Telegram",
+        'flood_wait_seconds_total': "Seconds of flood wait imposed by Telegram",
+        'filter_seconds': "Time spent matching a message against the rules",
+        'send_seconds': "Time from queueing a send to its delivery",
+        'lag_seconds': "Time from a message being posted to its delivery",
+        'stage_seconds': "Time spent per pipeline stage",
+        'config_reloads_total': "Reloads of the forwarding rules from config.json",
+        'edits_coalesced_total': "Message edits superseded by a later edit before being propagated",
+        'edits_applied_total': "Edits applied to the copy of a message in a destination",
+        'duplicates_skipped_total': "Messages not sent because the destination already received the same content",
+    }
+
+    def __init__(self, stage_timing=False):
+        self.stage_timing = stage_timing
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.hooks = []
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.BUCKETS)
+        histogram.observe(value)
+
+    def gauge(self, name, read, help_text=''):
+        # read() is called when the metrics are rendered
+        self.gauges[name] = (read, help_text)
+
+    def add_hook(self, hook):
+        # hook(stage, seconds) is called after every timed stage, e.g. to feed
+        # a profiler; stages are "filter", "text", "preview" and "send"
+        self.hooks.append(hook)
+
+    def stage(self, name):
+        if not (self.stage_timing or self.hooks):
+            return contextlib.nullcontext()
+        return self._time_stage(name)
+
+    @contextlib.contextmanager
+    def _time_stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+    def record_stage(self, name, seconds):
+        if self.stage_timing:
+            self.observe('stage_seconds', seconds, stage=name)
+        for hook in self.hooks:
+            hook(name, seconds)
+
+    def totals(self):
+        # Every series summed over its labels, for the periodic stats line
+        totals = {}
+        for (name, _), value in self.counters.items():
+            totals[name] = totals.get(name, 0) + value
+        for (name, _), histogram in self.histograms.items():
+            totals[name + '_sum'] = totals.get(name + '_sum', 0) + histogram.sum
+            totals[name + '_count'] = totals.get(name + '_count', 0) + histogram.count
+        return totals
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def describe(name, metric_type, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {self.PREFIX}{name} {help_text}")
+                lines.append(f"# TYPE {self.PREFIX}{name} {metric_type}")
+
+        for (name, labels), value in sorted(self.counters.items(), key=lambda item: item[0][0]):
+            describe(name, 'counter', self.HELP.get(name, name))
+            lines.append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0][0]):
+            describe(name, 'histogram', self.HELP.get(name, name))
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f"{self.PREFIX}{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.PREFIX}{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{self.PREFIX}{name}_count{self._labels(labels)} {histogram.count}")
+        for name, (read, help_text) in sorted(self.gauges.items()):
+            describe(name, 'gauge', help_text or name)
+            lines.append(f"{self.PREFIX}{name} {read()}")
+        return '\n'.join(lines) + '\n'
+
+    def _labels(self, labels):
+        if not labels:
+            return ''
+        escaped = (
+            (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels
+        )
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    async def serve(self, host='127.0.0.1', port=9464):
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.render().encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'Not Found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+class TokenBucket:
+    # Reservation based token bucket: every caller takes a token right away
+    # (the balance may go negative) and sleeps until its token is due, which
+    # keeps callers in FIFO order without a lock.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class RateLimiter:
+    # Account-wide budget plus one bucket per destination, sized after
+    # Telegram's documented limits (about 30 messages per second overall and
+    # one per second in a single chat). A rate of 0 disables the bucket.
+    def __init__(self, rate_limits=None):
+        rate_limits = rate_limits or {}
+        global_rate = rate_limits.get('global_per_second', 30)
+        self.global_bucket = TokenBucket(global_rate, rate_limits.get('global_burst')) if global_rate else None
+        self.destination_rate = rate_limits.get('per_destination_per_second', 1)
+        self.destination_burst = rate_limits.get('per_destination_burst', 3)
+        self.destination_buckets = {}
+
+    def reserve_destination(self, dest_channel):
+        if not self.destination_rate:
+            return 0
+        bucket = self.destination_buckets.get(dest_channel)
+        if bucket is None:
+            bucket = self.destination_buckets[dest_channel] = TokenBucket(self.destination_rate, self.destination_burst)
+        return bucket.reserve()
+
+    async def acquire_global(self):
+        if self.global_bucket is not None:
+            await self.global_bucket.acquire()
+
+class Account:
+    # A logged-in session that can send: its client, its own peer cache
+    # (access hashes differ between accounts) and its own account-wide budget.
+    def __init__(self, name, client, peers, rate_limiter):
+        self.name = name
+        self.client = client
+        self.peers = peers
+        self.rate_limiter = rate_limiter
+        self.in_flight = 0
+        self.sent = 0
+
+class HashSharding:
+    # Consistent hashing of destinations onto accounts, so a destination keeps
+    # its account and only a share of them moves when accounts come and go.
+    def __init__(self, accounts, replicas=64):
+        self.ring = sorted(
+            (self._hash(f"{account.name}#{replica}"), account.name)
+            for account in accounts for replica in range(replicas)
+        )
+
+    def _hash(self, value):
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+    def pick(self, dest_channel, available):
+        names = {account.name: account for account in available}
+        start = bisect.bisect(self.ring, (self._hash(dest_channel),))
+        for i in range(len(self.ring)):
+            name = self.ring[(start + i) % len(self.ring)][1]
+            if name in names:
+                return names[name]
+        return available[0]
+
+class LeastLoadedSharding:
+    # Each send goes to the account with the fewest sends in flight.
+    def __init__(self, accounts):
+        pass
+
+    def pick(self, dest_channel, available):
+        return min(available, key=lambda account: (account.in_flight, account.sent))
+
+SHARDING_STRATEGIES = {
+    'hash': HashSharding,
+    'least_loaded': LeastLoadedSharding,
+}
+
+class AccountPool:
+    def __init__(self, accounts, strategy='hash'):
+        self.accounts = list(accounts)
+        self.primary = self.accounts[0]
+        self.strategy = SHARDING_STRATEGIES[strategy](self.accounts)
+
+    def pick(self, dest_channel, available):
+        return self.strategy.pick(dest_channel, available)
+
+class SendJob:
+    def __init__(self, dest_channel, send, priority, sequence, account=None):
+        self.dest_channel = dest_channel
+        self.send = send
+        self.priority = priority
+        self.sequence = sequence
+        self.account = account
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.token_reserved = False
+        self.flood_waits = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+class SendScheduler:
+    # Central outbound queue shared by every rule. Workers always take the most
+    # urgent send (lowest priority, then oldest) and hand it to an account of
+    # the pool. A destination that is rate limited or hit a FloodWaitError on
+    # an account is backed off for that account only: the send moves to
+    # another account if there is one, otherwise it waits aside so the
+    # workers keep serving the other destinations. The send that failed is
+    # retried once the wait is over, nothing is dropped.
+    def __init__(self, rate_limiter, pool, workers=8, logger=None, metrics=None):
+        self.rate_limiter = rate_limiter
+        self.pool = pool
+        self.worker_count = workers
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics or Metrics()
+        self.queue = None
+        self.workers = []
+        self.sequence = itertools.count()
+        self.blocked_until = {}
+        self.parked = {}
+        self.deferred = 0
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+        self.retries = 0
+        self.completed = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def start(self):
+        if self.workers:
+            return
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.ensure_future(self._work()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, dest_channel, send, priority=0, account=None):
+        # send(account, dest_channel) performs the request with that account.
+        # A job can be pinned to the account with the given name, e.g. to edit
+        # a message that only its sender can edit.
+        self.start()
+        if account is not None and all(candidate.name != account for candidate in self.pool.accounts):
+            account = None
+        job = SendJob(dest_channel, send, priority, next(self.sequence), account)
+        self._enqueue(job)
+        return job.future
+
+    @property
+    def queue_depth(self):
+        return (self.queue.qsize() if self.queue else 0) + self.parked_sends + self.deferred
+
+    @property
+    def parked_sends(self):
+        # Sends held back until a flood wait of their destination is over
+        return sum(len(jobs) for jobs in self.parked.values())
+
+    @property
+    def avg_queue_wait(self):
+        return self.total_queue_wait / self.completed if self.completed else 0.0
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'queued': self.queue.qsize() if self.queue else 0,
+            'parked': self.parked_sends,
+            'deferred': self.deferred,
+            'blocked_destinations': {
+                f"{name}/{dest_channel}": round(until - now, 1)
+                for (name, dest_channel), until in self.blocked_until.items()
+            },
+            'accounts': {
+                account.name: {'in_flight': account.in_flight, 'sent': account.sent}
+                for account in self.pool.accounts
+            },
+            'completed': self.completed,
+            'retries': self.retries,
+            'flood_waits': self.flood_waits,
+            'flood_wait_seconds': self.flood_wait_seconds,
+            'avg_queue_wait': self.avg_queue_wait,
+            'max_queue_wait': self.max_queue_wait,
+        }
+
+    def _available(self, job):
+        return [
+            account for account in self.pool.accounts
+            if (account.name, job.dest_channel) not in self.blocked_until
+            and (job.account is None or account.name == job.account)
+        ]
+
+    def _enqueue(self, job):
+        if self._available(job):
+            self.queue.put_nowait(job)
+        else:
+            self.parked.setdefault(job.dest_channel, []).append(job)
+
+    def _defer(self, job, delay):
+        self.deferred += 1
+
+        def resume():
+            self.deferred -= 1
+            self._enqueue(job)
+
+        asyncio.get_running_loop().call_later(delay, resume)
+
+    def _block(self, account, dest_channel, seconds):
+        key = (account.name, dest_channel)
+        until = time.monotonic() + seconds
+        if until <= self.blocked_until.get(key, 0):
+            return
+        first = key not in self.blocked_until
+        self.blocked_until[key] = until
+        if first:
+            asyncio.get_running_loop().call_later(seconds, self._unblock, key)
+
+    def _unblock(self, key):
+        remaining = self.blocked_until.get(key, 0) - time.monotonic()
+        if remaining > 0:
+            # The wait was extended by a later FloodWaitError
+            asyncio.get_running_loop().call_later(remaining, self._unblock, key)
+            return
+        self.blocked_until.pop(key, None)
+        for job in sorted(self.parked.pop(key[1], [])):
+            self.queue.put_nowait(job)
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            if job.future.done():
+                continue
+            available = self._available(job)
+            if not available:
+                self.parked.setdefault(job.dest_channel, []).append(job)
+                continue
+            if not job.token_reserved:
+                job.token_reserved = True
+                delay = self.rate_limiter.reserve_destination(job.dest_channel)
+                if delay > 0:
+                    self._defer(job, delay)
+                    continue
+            account = self.pool.pick(job.dest_channel, available)
+            await account.rate_limiter.acquire_global()
+
+            queue_wait = time.monotonic() - job.enqueued_at
+            account.in_flight += 1
+            try:
+                result = await job.send(account, job.dest_channel)
+            except FloodWaitError as e:
+                self.flood_waits += 1
+                self.flood_wait_seconds += e.seconds
+                self.retries += 1
+                job.flood_waits += 1
+                self.metrics.inc('flood_waits_total', destination=job.dest_channel, account=account.name)
+                self.metrics.inc('flood_wait_seconds_total', e.seconds, destination=job.dest_channel,
+                                 account=account.name)
+                self._block(account, job.dest_channel, e.seconds)
+                self._enqueue(job)
+                self.logger.warning(
+                    f"Rate limit hit for channel {job.dest_channel} on account {account.name}. "
+                    f"Retrying in {e.seconds} seconds or on another account ({self.queue_depth} sends pending)"
+                )
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                account.sent += 1
+                self.completed += 1
+                self.total_queue_wait += queue_wait
+                self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                account.in_flight -= 1
+
+class SenderProcess:
+    # One sender process and the bounded queue that feeds it.
+    def __init__(self, name, process, jobs):
+        self.name = name
+        self.process = process
+        self.jobs = jobs
+        self.in_flight = 0
+        self.sent = 0
+
+class SenderProcesses:
+    # Moves all outbound sends out of the receiving process. Each extra account
+    # gets a sender process running its own send scheduler; the receiver only
+    # filters, formats and queues picklable work items. The job queues are
+    # bounded, so when the senders fall behind, queueing blocks (in a thread,
+    # not on the event loop) instead of piling up in memory.
+    def __init__(self, accounts, config, peer_ids, client_factory=TelegramClient, strategy='hash', queue_size=1000,
+                 logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        context = multiprocessing.get_context('spawn')
+        self.results = context.Queue()
+        self.senders = []
+        for account in accounts:
+            jobs = context.Queue(queue_size)
+            process = context.Process(
+                target=run_sender, args=(account, config, sorted(peer_ids), jobs, self.results, client_factory),
+                name=f"sender-{account['phone_number']}", daemon=True
+            )
+            self.senders.append(SenderProcess(account['phone_number'], process, jobs))
+        self.strategy = SHARDING_STRATEGIES[strategy](self.senders)
+        self.ids = itertools.count()
+        self.pending = {}
+        self.reader = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for sender in self.senders:
+            sender.process.start()
+        self.reader = asyncio.ensure_future(self._read_results())
+
+    async def stop(self):
+        if not self.running:
+            return
+        loop = asyncio.get_running_loop()
+        for sender in self.senders:
+            if sender.process.is_alive():
+                await loop.run_in_executor(None, self._put, sender, None)
+        for sender in self.senders:
+            await loop.run_in_executor(None, sender.process.join, 30)
+            if sender.process.is_alive():
+                sender.process.terminate()
+        self.running = False
+        await self.reader
+        for sender, future in self.pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError(f"Sender process {sender.name} stopped"))
+        self.pending = {}
+
+    async def submit(self, dest_channel, work, priority=0, account=None):
+        # Resolves to the name of the sending account and the IDs of the
+        # messages sent to the destination
+        available = [sender for sender in self.senders if sender.process.is_alive()]
+        if not available:
+            raise RuntimeError("No sender process is running")
+        pinned = [sender for sender in available if sender.name == account]
+        sender = pinned[0] if pinned else self.strategy.pick(dest_channel, available)
+        job_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[job_id] = (sender, future)
+        sender.in_flight += 1
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._put, sender, dict(work, id=job_id, dest_channel=dest_channel, priority=priority)
+            )
+            return await future
+        finally:
+            sender.in_flight -= 1
+            self.pending.pop(job_id, None)
+
+    def stats(self):
+        return {
+            sender.name: {
+                'alive': sender.process.is_alive(), 'in_flight': sender.in_flight, 'sent': sender.sent
+            }
+            for sender in self.senders
+        }
+
+    def _put(self, sender, work):
+        # Blocks while the sender's queue is full, but gives up if the sender
+        # process dies so the caller is not stuck forever
+        while True:
+            try:
+                sender.jobs.put(work, timeout=1)
+                return
+            except queue.Full:
+                if not sender.process.is_alive():
+                    raise RuntimeError(f"Sender process {sender.name} is not running")
+
+    def _get_result(self):
+        try:
+            return self.results.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+    async def _read_results(self):
+        loop = asyncio.get_running_loop()
+        while self.running or self.pending:
+            result = await loop.run_in_executor(None, self._get_result)
+            if result is None:
+                self._fail_dead_senders()
+                if not self.running:
+                    return
+                continue
+            job_id, sent, error = result
+            sender, future = self.pending.get(job_id, (None, None))
+            if future is None or future.done():
+                continue
+            if error is None:
+                sender.sent += 1
+                future.set_result((sender.name, sent))
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def _fail_dead_senders(self):
+        for sender, future in list(self.pending.values()):
+            if not future.done() and not sender.process.is_alive():
+                future.set_exception(RuntimeError(f"Sender process {sender.name} exited"))
+
+class Outbox:
+    # Delivery ledger of (source_chat_id, message_id, dest_channel, status) in
+    # SQLite (WAL mode). Status changes are buffered in memory and committed
+    # in batches, so recording a send costs a dict write on the hot path.
+    # Entries still 'pending' at startup were interrupted and get replayed;
+    # 'sent' entries are never forwarded again. Sent entries also keep the ID
+    # of the copy in the destination and the account that sent it, so that
+    # later edits can be applied to it.
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    def __init__(self, path, flush_interval=0.5, batch_size=1000, retention_days=7):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retention = retention_days * 86400
+        self.logger = logging.getLogger(__name__)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                source_chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                dest_channel INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                copy_id INTEGER,
+                copy_account TEXT,
+                PRIMARY KEY (source_chat_id, message_id, dest_channel)
+            ) WITHOUT ROWID
+        """)
+        columns = {row[1] for row in self.db.execute('PRAGMA table_info(outbox)')}
+        if 'copy_id' not in columns:
+            # Ledger written by an older version
+            self.db.execute('ALTER TABLE outbox ADD COLUMN copy_id INTEGER')
+            self.db.execute('ALTER TABLE outbox ADD COLUMN copy_account TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, updated_at)')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                source_chat_id INTEGER PRIMARY KEY,
+                last_message_id INTEGER NOT NULL
+            )
+        """)
+        self.db.commit()
+        self.buffer = {}
+        self.last_message_ids = dict(self.db.execute('SELECT source_chat_id, last_message_id FROM checkpoints'))
+        self.dirty_checkpoints = set()
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.flush()
+        self.db.close()
+
+    def status(self, source_chat_id, message_id, dest_channel):
+        key = (source_chat_id, message_id, dest_channel)
+        if key in self.buffer:
+            return self.buffer[key][0]
+        row = self.db.execute(
+            'SELECT status FROM outbox WHERE source_chat_id = ? AND message_id = ? AND dest_channel = ?', key
+        ).fetchone()
+        return row[0] if row else None
+
+    def is_delivered(self, source_chat_id, message_ids, dest_channel):
+        return all(self.status(source_chat_id, message_id, dest_channel) == self.SENT for message_id in message_ids)
+
+    def mark(self, source_chat_id, message_ids, dest_channel, status, copy_ids=None, account=None):
+        now = time.time()
+        copy_ids = copy_ids or [None] * len(message_ids)
+        for message_id, copy_id in zip(message_ids, copy_ids):
+            self.buffer[(source_chat_id, message_id, dest_channel)] = (
+                status, now, copy_id, account if copy_id is not None else None
+            )
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def copy_of(self, source_chat_id, message_id, dest_channel):
+        # (account, copy_id) of the message in the destination, or None
+        key = (source_chat_id, message_id, dest_channel)
+        if key in self.buffer and self.buffer[key][2] is not None:
+            return self.buffer[key][3], self.buffer[key][2]
+        row = self.db.execute(
+            'SELECT copy_account, copy_id FROM outbox WHERE source_chat_id = ? AND message_id = ? AND dest_channel = ?',
+            key
+        ).fetchone()
+        return tuple(row) if row and row[1] is not None else None
+
+    def last_message_id(self, source_chat_id):
+        return self.last_message_ids.get(source_chat_id)
+
+    def advance(self, source_chat_id, message_id):
+        # Highest message ID of the source that has been processed
+        if message_id > self.last_message_ids.get(source_chat_id, 0):
+            self.last_message_ids[source_chat_id] = message_id
+            self.dirty_checkpoints.add(source_chat_id)
+
+    def flush(self):
+        if not self.buffer and not self.dirty_checkpoints:
+            return
+        rows = [key + value for key, value in self.buffer.items()]
+        checkpoints = [(source, self.last_message_ids[source]) for source in self.dirty_checkpoints]
+        self.buffer = {}
+        self.dirty_checkpoints = set()
+        with self.db:
+            self.db.executemany("""
+                INSERT INTO outbox (source_chat_id, message_id, dest_channel, status, updated_at, copy_id, copy_account)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source_chat_id, message_id, dest_channel)
+                DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at,
+                              copy_id = COALESCE(excluded.copy_id, copy_id),
+                              copy_account = COALESCE(excluded.copy_account, copy_account)
+            """, rows)
+            self.db.executemany("""
+                INSERT INTO checkpoints (source_chat_id, last_message_id) VALUES (?, ?)
+                ON CONFLICT (source_chat_id) DO UPDATE SET last_message_id = excluded.last_message_id
+            """, checkpoints)
+
+    def pending(self):
+        self.flush()
+        return self.db.execute(
+            'SELECT source_chat_id, message_id, dest_channel FROM outbox WHERE status = ? ORDER BY source_chat_id, message_id',
+            (self.PENDING,)
+        ).fetchall()
+
+    def compact(self):
+        # Finished entries are only needed to filter duplicates of recent messages
+        self.flush()
+        with self.db:
+            self.db.execute(
+                'DELETE FROM outbox WHERE status != ? AND updated_at < ?', (self.PENDING, time.time() - self.retention)
+            )
+
+    async def _run(self):
+        last_compaction = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.monotonic() - last_compaction > 3600:
+                    self.compact()
+                    last_compaction = time.monotonic()
+            except sqlite3.Error as e:
+                self.logger.error(f"Error writing outbox {self.path}: {str(e)}", exc_info=True)
+
+async def retry_flood_waits(request, logger, label):
+    # Awaits request() until it goes through, sleeping out every
+    # FloodWaitError. The clients never sleep on their own
+    # (flood_sleep_threshold is 0) so that the send scheduler can move sends
+    # around a wait; requests that are not sends wait here instead.
+    while True:
+        try:
+            return await request()
+        except FloodWaitError as e:
+            logger.warning(f"{label} rate limited, retrying in {e.seconds} seconds")
+            await asyncio.sleep(e.seconds)
+
+class PeerCache:
+    # Chat IDs resolved to InputPeers once and kept in an LRU with a TTL.
+    # The cache is persisted next to the session file, so a cold start (or a
+    # wiped session) does not need get_dialogs to find the access hashes.
+    PEER_TYPES = {
+        'channel': (InputPeerChannel, 'channel_id'),
+        'chat': (InputPeerChat, 'chat_id'),
+        'user': (InputPeerUser, 'user_id'),
+    }
+
+    def __init__(self, client, path, ttl=7 * 86400, max_size=10000):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.logger = logging.getLogger(__name__)
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                stored = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+        for peer_id, (peer_type, entity_id, access_hash, resolved_at) in stored.items():
+            peer = self._decode(peer_type, entity_id, access_hash)
+            if peer is not None:
+                self.entries[int(peer_id)] = (peer, resolved_at)
+
+    def save(self):
+        if not self.dirty:
+            return
+        stored = {}
+        for peer_id, (peer, resolved_at) in self.entries.items():
+            encoded = self._encode(peer)
+            if encoded is not None:
+                stored[str(peer_id)] = encoded + [resolved_at]
+        with open(self.path, "w") as file:
+            json.dump(stored, file)
+        self.dirty = False
+
+    def _encode(self, peer):
+        if isinstance(peer, InputPeerSelf):
+            return ['self', 0, 0]
+        for peer_type, (cls, attribute) in self.PEER_TYPES.items():
+            if isinstance(peer, cls):
+                return [peer_type, getattr(peer, attribute), getattr(peer, 'access_hash', 0)]
+        return None
+
+    def _decode(self, peer_type, entity_id, access_hash):
+        if peer_type == 'self':
+            return InputPeerSelf()
+        if peer_type not in self.PEER_TYPES:
+            return None
+        cls, attribute = self.PEER_TYPES[peer_type]
+        if cls is InputPeerChat:
+            return cls(entity_id)
+        return cls(entity_id, access_hash)
+
+    def cached(self, peer_id):
+        entry = self.entries.get(peer_id)
+        if entry is None:
+            return None
+        peer, resolved_at = entry
+        if time.time() - resolved_at > self.ttl:
+            del self.entries[peer_id]
+            return None
+        self.entries.move_to_end(peer_id)
+        return peer
+
+    def store(self, peer_id, peer):
+        self.entries[peer_id] = (peer, time.time())
+        self.entries.move_to_end(peer_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def invalidate(self, peer_id):
+        if self.entries.pop(peer_id, None) is not None:
+            self.dirty = True
+
+    async def get(self, peer_id):
+        peer = self.cached(peer_id)
+        if peer is None:
+            peer = await self.client.get_input_entity(peer_id)
+            self.store(peer_id, peer)
+        return peer
+
+    async def warm_up(self, peer_ids):
+        unresolved = set()
+        for peer_id in set(peer_ids):
+            try:
+                await retry_flood_waits(lambda: self.get(peer_id), self.logger, f"Resolving chat {peer_id}")
+            except ValueError:
+                unresolved.add(peer_id)
+
+        async def scan_dialogs():
+            # A pass cut short by a flood wait starts over, finding only the
+            # chats that are still missing
+            async for dialog in self.client.iter_dialogs():
+                if dialog.id in unresolved:
+                    self.store(dialog.id, dialog.input_entity)
+                    unresolved.discard(dialog.id)
+                    if not unresolved:
+                        break
+
+        if unresolved:
+            # Unknown to the session as well: a single pass over the dialogs
+            # finds their access hashes
+            await retry_flood_waits(scan_dialogs, self.logger, "Listing dialogs")
+            for peer_id in unresolved:
+                self.logger.warning(f"Could not resolve chat {peer_id}, is the account a member?")
+        self.save()
+
+class DialogIndex:
+    # Persisted snapshot of the account's dialogs (id, title, type, access
+    # hash, top message) that can be searched offline. Dialogs come from
+    # Telegram ordered by their last message, so a refresh stops at the first
+    # unpinned dialog whose top message has not changed since the snapshot.
+    def __init__(self, path):
+        self.path = path
+        self.dialogs = {}
+        self.updated_at = None
+        try:
+            with open(self.path, "r") as file:
+                stored = json.load(file)
+            self.dialogs = {entry['id']: entry for entry in stored['dialogs']}
+            self.updated_at = stored.get('updated_at')
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    async def refresh(self, client, full=False):
+        seen = {} if full else None
+        changed = 0
+        async for dialog in client.iter_dialogs():
+            entry = self._entry(dialog)
+            if seen is not None:
+                seen[entry['id']] = entry
+            elif self.dialogs.get(entry['id']) == entry and not dialog.pinned:
+                break
+            if self.dialogs.get(entry['id']) != entry:
+                changed += 1
+            self.dialogs[entry['id']] = entry
+            yield dialog
+        if seen is not None:
+            # A full refresh also forgets the dialogs that were left or deleted
+            self.dialogs = seen
+        self.updated_at = datetime.now().isoformat(timespec='seconds')
+        self.save()
+
+    def _entry(self, dialog):
+        if dialog.is_user:
+            chat_type = 'user'
+        elif dialog.is_group:
+            chat_type = 'group'
+        else:
+            chat_type = 'channel'
+        date = dialog.message.date if dialog.message is not None else None
+        return {
+            'id': dialog.id,
+            'title': dialog.title,
+            'type': chat_type,
+            'access_hash': getattr(dialog.input_entity, 'access_hash', None),
+            'top_message': dialog.message.id if dialog.message is not None else 0,
+            'date': date.isoformat() if date else None,
+        }
+
+    def save(self):
+        with open(self.path, "w") as file:
+            json.dump({'updated_at': self.updated_at, 'dialogs': self.entries()}, file, ensure_ascii=False)
+
+    def entries(self):
+        return sorted(self.dialogs.values(), key=lambda entry: entry['date'] or '', reverse=True)
+
+    def search(self, text):
+        text = text.lower()
+        return [entry for entry in self.entries() if text in (entry['title'] or '').lower()]
+
+class AlbumBuffer:
+    # Collects the messages of an album (same grouped_id) as they arrive and
+    # hands them over as one batch once no new item has shown up for
+    # flush_delay seconds.
+    def __init__(self, on_flush, flush_delay=0.5):
+        self.on_flush = on_flush
+        self.flush_delay = flush_delay
+        self.albums = {}
+        self.tasks = set()
+
+    def add(self, message):
+        key = (message.chat_id, message.grouped_id)
+        album = self.albums.get(key)
+        if album is None:
+            album = self.albums[key] = {'messages': [], 'timer': None}
+        else:
+            album['timer'].cancel()
+        album['messages'].append(message)
+        album['timer'] = asyncio.get_running_loop().call_later(self.flush_delay, self.flush, key)
+
+    def flush(self, key):
+        album = self.albums.pop(key, None)
+        if album is None:
+            return
+        album['timer'].cancel()
+        messages = sorted(album['messages'], key=lambda message: message.id)
+        task = asyncio.ensure_future(self.on_flush(messages))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def __len__(self):
+        return len(self.albums)
+
+class EditCoalescer:
+    # Holds the edits of a message for `window` seconds from the first one and
+    # then hands over only its latest version, so a post edited many times in
+    # a row is propagated once per window instead of once per edit. Unlike the
+    # album delay the window is not extended by later edits, so a post that
+    # keeps changing is still pushed regularly.
+    def __init__(self, on_flush, window=2.0):
+        self.on_flush = on_flush
+        self.window = window
+        self.edits = {}
+        self.tasks = set()
+
+    def add(self, message):
+        # Returns True if the edit replaced one that was still waiting
+        key = (message.chat_id, message.id)
+        edit = self.edits.get(key)
+        if edit is not None:
+            edit['message'] = message
+            return True
+        self.edits[key] = {'message': message, 'timer': None}
+        if self.window:
+            self.edits[key]['timer'] = asyncio.get_running_loop().call_later(self.window, self.flush, key)
+        else:
+            self.flush(key)
+        return False
+
+    def flush(self, key):
+        edit = self.edits.pop(key, None)
+        if edit is None:
+            return
+        if edit['timer'] is not None:
+            edit['timer'].cancel()
+        task = asyncio.ensure_future(self.on_flush(edit['message']))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def __len__(self):
+        return len(self.edits)
+
+class CopyMap:
+    # Bounded map of (source_chat_id, message_id, dest_channel) to the
+    # (account, message_id) of the copy sent there, least recently used
+    # entries are evicted first.
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, source_chat_id, message_id, dest_channel):
+        key = (source_chat_id, message_id, dest_channel)
+        copy = self.entries.get(key)
+        if copy is not None:
+            self.entries.move_to_end(key)
+        return copy
+
+    def put(self, source_chat_id, message_id, dest_channel, account, copy_id):
+        key = (source_chat_id, message_id, dest_channel)
+        self.entries[key] = (account, copy_id)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+class ContentSignature:
+    # digest identifies the normalized text and the media exactly, media the
+    # media alone, and simhash (or None) the text up to small changes;
+    # source is the chat the content was posted in
+    __slots__ = ('digest', 'media', 'simhash', 'source')
+
+    def __init__(self, digest, media, simhash=None, source=None):
+        self.digest = digest
+        self.media = media
+        self.simhash = simhash
+        self.source = source
+
+def media_id(media):
+    # ID of the photo or document of a message, the same wherever the file
+    # is forwarded; None for other media such as web page previews
+    for kind in ('photo', 'document'):
+        item = getattr(media, kind, None)
+        if getattr(item, 'id', None) is not None:
+            return item.id
+    return None
+
+class DuplicateFilter:
+    # Content sent to each destination during the last `window` seconds, so
+    # that a post cross-posted by several sources reaches a destination once.
+    # Every entry remembers the source that sent it, and a source repeating
+    # its own content (a daily greeting, the same sticker) is not held back.
+    # Entries are 64-bit hashes kept in two generations: lookups check both,
+    # and the older one is dropped whenever the current one is `window`
+    # seconds old or holds half of max_entries, so memory stays flat however
+    # long the forwarder runs. With max_distance, texts whose SimHash differs
+    # in at most that many bits (with the same media) are duplicates as well;
+    # the hash is split into max_distance + 1 bands, one of which has to match
+    # exactly, so only the hashes sharing a band are compared.
+    SIMHASH_MIN_WORDS = 8
+
+    def __init__(self, window=3600, max_entries=100000, max_distance=0):
+        self.window = window
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        width = 64 // (max_distance + 1)
+        self.bands = [
+            (i * width, (1 << (64 - i * width if i == max_distance else width)) - 1)
+            for i in range(max_distance + 1)
+        ]
+        self.generations = [self._generation(), self._generation()]
+        self.rotated_at = time.monotonic()
+        # One int object per source chat shared by all of its entries
+        self.sources = {}
+
+    @staticmethod
+    def _generation():
+        return {'exact': {}, 'near': {}, 'size': 0}
+
+    def signature(self, messages):
+        # Case, punctuation and spacing are ignored. None when there is
+        # nothing to compare, e.g. a message with neither text nor a file.
+        words = WORD_PATTERN.findall(' '.join(message.raw_text or '' for message in messages).casefold())
+        media = ','.join(str(file_id) for file_id in (media_id(message.media) for message in messages) if file_id)
+        if not words and not media:
+            return None
+        digest = hashlib.blake2b(f"{' '.join(words)}\0{media}".encode(), digest_size=8).digest()
+        simhash = None
+        if self.max_distance and len(words) >= self.SIMHASH_MIN_WORDS:
+            simhash = self._simhash(words)
+        source = self.sources.setdefault(messages[0].chat_id, messages[0].chat_id)
+        return ContentSignature(int.from_bytes(digest, 'big'), hash(media), simhash, source)
+
+    @staticmethod
+    def _simhash(words):
+        # Every bit is the majority vote of the hashes of the words, counted
+        # one column of the bit strings at a time. Changing one word of a
+        # 30-word text typically flips 4 to 7 bits, unrelated texts differ in
+        # about 20 or more.
+        rows = [
+            format(int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'big'), '064b')
+            for word in words
+        ]
+        half = len(rows) / 2
+        return int(''.join('1' if column.count('1') > half else '0' for column in zip(*rows)), 2)
+
+    def _band_keys(self, dest_channel, signature):
+        return [
+            hash((dest_channel, signature.media, i, (signature.simhash >> shift) & mask))
+            for i, (shift, mask) in enumerate(self.bands)
+        ]
+
+    def claim(self, dest_channel, signature):
+        # Records the content for the destination and returns True, or False
+        # if another source already sent it there
+        self._rotate()
+        source = signature.source
+        key = hash((dest_channel, signature.digest))
+        if any(generation['exact'].get(key, source) != source for generation in self.generations):
+            return False
+        band_keys = self._band_keys(dest_channel, signature) if signature.simhash is not None else []
+        for band_key in band_keys:
+            for generation in self.generations:
+                simhash, claimed_by = generation['near'].get(band_key, (None, source))
+                if claimed_by != source and bin(simhash ^ signature.simhash).count('1') <= self.max_distance:
+                    return False
+        current = self.generations[0]
+        if key not in current['exact']:
+            current['size'] += 1
+        current['exact'][key] = source
+        # One hash per band is enough: texts sharing a band with a different
+        # hash are rare, and the latest one is the most likely to be repeated
+        for band_key in band_keys:
+            current['near'][band_key] = (signature.simhash, source)
+        return True
+
+    def forget(self, dest_channel, signature):
+        # Undoes a claim whose send failed, so that another source can still
+        # deliver the content
+        key = hash((dest_channel, signature.digest))
+        band_keys = self._band_keys(dest_channel, signature) if signature.simhash is not None else []
+        for generation in self.generations:
+            if generation['exact'].get(key) == signature.source:
+                del generation['exact'][key]
+            for band_key in band_keys:
+                if generation['near'].get(band_key) == (signature.simhash, signature.source):
+                    del generation['near'][band_key]
+
+    def _rotate(self):
+        now = time.monotonic()
+        current = self.generations[0]
+        if now - self.rotated_at >= self.window or current['size'] >= self.max_entries // 2:
+            self.generations = [self._generation(), current]
+            self.rotated_at = now
+
+    def __len__(self):
+        return sum(len(generation['exact']) for generation in self.generations)
+
+class ApprovalQueue:
+    # Previews waiting for a human decision. They are asked one at a time with
+    # prompt_async, so waiting for an answer only holds back the message being
+    # approved and never the event loop or the other rules.
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.pending = asyncio.Queue()
+        self.session = PromptSession()
+        self.worker = None
+
+    async def request(self, preview, destinations):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((preview, destinations, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            preview, destinations, future = await self.pending.get()
+            if future.cancelled():
+                continue
+            translate = self.forwarder.translate
+            language = self.forwarder.language
+            print("\n" + translate("Message Preview:", language))
+            print(preview)
+            print(f"-> {destinations}")
+            try:
+                answer = await self.session.prompt_async(translate("Send this message? (y/n): ", language))
+            except (EOFError, KeyboardInterrupt):
+                answer = 'n'
+            if not future.cancelled():
+                future.set_result(answer.lower().strip() in ('y', 's'))
+
 class TelegramForwarder:
-    def __init__(self, api_id, api_hash, phone_number, language='en'):
+    def __init__(self, api_id, api_hash, phone_number, language='en', require_approval=True, config=None, client=None,
+                 client_factory=TelegramClient):
         self.api_id = api_id
         self.api_hash = api_hash
         self.phone_number = phone_number
         self.language = language
-        self.client = TelegramClient('session_' + phone_number, api_id, api_hash)
+        self.config = config or {}
+        self.client_factory = client_factory
+        self.client = client or client_factory('session_' + phone_number, api_id, api_hash)
         self.logger = logging.getLogger(__name__)
+        self.require_approval = require_approval
+        self.approvals = ApprovalQueue(self) if require_approval else None
+        self.rate_limiter = RateLimiter(self.config.get('rate_limits'))
+        self.config_path = CONFIG_PATH
+        self.rule_index = None
+        self.reload_lock = asyncio.Lock()
+        self.outbox = None
+        self.senders = None
+        self.catching_up = {}
+        self.unfinished = {}
+        self.finished = {}
+        self.live_from = {}
+        self.recovered_ids = {}
+        self.fetched_media = OrderedDict()
+        self.copies = CopyMap(self.config.get('edit_map_size', 10000))
+        self.deliveries = {}
+        dedup_config = self.config.get('dedup', {})
+        if dedup_config is True:
+            dedup_config = {}
+        self.dedup = None if dedup_config is False else DuplicateFilter(
+            dedup_config.get('window', 3600), dedup_config.get('max_entries', 100000),
+            dedup_config.get('max_distance', 0)
+        )
+        # "metrics": true or false only keeps the defaults
+        metrics_config = self.config.get('metrics', {})
+        self.metrics_config = metrics_config if isinstance(metrics_config, dict) else {}
+        self.metrics = Metrics(self.metrics_config.get('stage_timing', False))
+        self.metrics_server = None
+        self.stats_reporter = None
+        self.peers = PeerCache(
+            self.client, self.config.get('peer_cache_path', f"session_{phone_number}.peers.json"),
+            self.config.get('peer_cache_ttl', 7 * 86400)
+        )
+        # The account from credentials.txt receives the updates; the ones
+        # listed under "accounts" in config.json only help sending
+        self.primary = Account(phone_number, self.client, self.peers, self.rate_limiter)
+        accounts = [self.primary]
+        extra_accounts = self.config.get('accounts', [])
+        if self.config.get('sender_processes', False):
+            # The extra accounts send from their own processes instead
+            if not extra_accounts:
+                raise ValueError('"sender_processes" needs at least one account under "accounts"')
+            extra_accounts = []
+        for account in extra_accounts:
+            name = account['phone_number']
+            client = client_factory('session_' + name, account['api_id'], account['api_hash'])
+            peers = PeerCache(client, f"session_{name}.peers.json", self.config.get('peer_cache_ttl', 7 * 86400))
+            accounts.append(Account(name, client, peers, RateLimiter(self.config.get('rate_limits'))))
+        self.pool = AccountPool(accounts, self.config.get('sharding', 'hash'))
+        self.scheduler = SendScheduler(
+            self.rate_limiter, self.pool, self.config.get('max_concurrent_sends', 8), self.logger, self.metrics
+        )
+        self.metrics.gauge('send_queue_depth', lambda: self.scheduler.queue_depth, "Sends waiting in the scheduler")
+        self.metrics.gauge('sends_parked', lambda: self.scheduler.parked_sends,
+                           "Sends held back until a flood wait of their destination is over")
+        self.metrics.gauge('sends_deferred', lambda: self.scheduler.deferred,
+                           "Sends waiting for the rate limit of their destination")
+        self.metrics.gauge('blocked_destinations', lambda: len(self.scheduler.blocked_until),
+                           "Destinations paused by a flood wait, counted per account")
+        self.metrics.gauge('send_queue_wait_avg_seconds', lambda: self.scheduler.avg_queue_wait,
+                           "Average time a completed send waited in the scheduler")
+        self.metrics.gauge('send_queue_wait_max_seconds', lambda: self.scheduler.max_queue_wait,
+                           "Longest time a completed send waited in the scheduler")
+        if self.config.get('sender_processes', False):
+            self.metrics.gauge('sender_processes_alive', lambda: sum(
+                sender['alive'] for sender in (self.senders.stats() if self.senders else {}).values()
+            ), "Sender processes running")
+        if self.dedup is not None:
+            self.metrics.gauge('dedup_entries', lambda: len(self.dedup), "Content hashes held for deduplication")
 
-    async def list_chats(self):
+    async def list_chats(self, output_format='text', full_refresh=False):
         await self.client.connect()
 
         # Ensure you're authorized
@@ -32,16 +1682,24 @@ class TelegramForwarder:
             await self.client.send_code_request(self.phone_number)
             await self.client.sign_in(self.phone_number, input(self.translate('Enter the code: ', self.language)))
 
-        # Get a list of all the dialogs (chats)
-        dialogs = await self.client.get_dialogs()
-        chats_file = open(f"chats_of_{self.phone_number}.txt", "w")
-        # Print information about each chat
-        for dialog in dialogs:
-            print(f"Chat ID: {dialog.id}, Title: {dialog.title}")
-            chats_file.write(f"Chat ID: {dialog.id}, Title: {dialog.title} \n")
-          
+        # Stream the dialogs that changed since the last run into the index.
+        # Only the chats of the forwarding rules go to the peer cache, the
+        # index keeps the access hashes of all the others.
+        dialog_index = DialogIndex(f"dialogs_of_{self.phone_number}.json")
+        rule_peers = self._rule_peers(self.config.get('forward_rules', []))
+        async for dialog in dialog_index.refresh(self.client, full=full_refresh):
+            if dialog.id in rule_peers:
+                self.peers.store(dialog.id, dialog.input_entity)
+        self.peers.save()
+
+        entries = dialog_index.entries()
+        with open(f"chats_of_{self.phone_number}.txt", "w") as chats_file:
+            for entry in entries:
+                chats_file.write(f"Chat ID: {entry['id']}, Title: {entry['title']} \n")
+        write_chats(entries, output_format)
 
-        print(self.translate('List of groups printed successfully!', self.language))
+        if output_format == 'text':
+            print(self.translate('List of groups printed successfully!', self.language))
 
     async def forward_messages_to_channels(self, forward_rules):
         await self.client.connect()
@@ -51,91 +1709,881 @@ class TelegramForwarder:
             await self.client.send_code_request(self.phone_number)
             await self.client.sign_in(self.phone_number, input(self.translate('Enter the code: ', self.language)))
 
-        @self.client.on(events.NewMessage())
+        rule_index = self.rule_index = RuleIndex(forward_rules)
+        await self._open_pipeline(forward_rules)
+        if self.outbox is not None and self.config.get('catch_up', True):
+            # Sources with a checkpoint missed whatever was posted while the
+            # forwarder was down
+            self.catching_up = {
+                source_chat_id: 0 for source_chat_id in rule_index.sources
+                if self.outbox.last_message_id(source_chat_id) is not None
+            }
+
+        # The handlers always read self.rule_index, which a config reload
+        # replaces in one assignment, so an update is matched against either
+        # the old or the new rules and none is dropped in between
+        async def forward_batch(messages):
+            await self._dispatch(self.rule_index, messages)
+            self._checkpoint(messages)
+
+        albums = AlbumBuffer(forward_batch, self.config.get('album_flush_delay', 0.5))
+
         async def handler(event):
-            for rule in forward_rules:
-                if event.chat_id == rule['source_chat_id']:
-                    try:
-                        if self._should_forward(event.message, rule):
-                            await self._forward_message(event.message, rule)
-                    except FloodWaitError as e:
-                        self.logger.warning(f"Rate limit hit. Waiting for {e.seconds} seconds")
-                        await asyncio.sleep(e.seconds)
-                    except Exception as e:
-                        self.logger.error(f"Error forwarding message: {str(e)}", exc_info=True)
-
-        @self.client.on(events.MessageEdited())
+            if not self._receive(event.message):
+                return
+            if event.message.grouped_id:
+                albums.add(event.message)
+                return
+            await forward_batch([event.message])
+
+        async def forward_edit(message):
+            start = time.perf_counter()
+            rules = self.rule_index.match_edit(message.chat_id, message)
+            self.metrics.record_stage('filter', time.perf_counter() - start)
+            await asyncio.gather(*(self._forward([message], rule, is_edit=True) for rule in rules))
+
+        # Rapid edits of a message are coalesced, only the latest version is
+        # propagated once the window is over
+        edits = EditCoalescer(forward_edit, self.config.get('edit_coalesce_window', 2.0))
+
         async def edit_handler(event):
-            for rule in forward_rules:
-                if event.chat_id == rule['source_chat_id'] and rule.get('forward_edits', False):
-                    try:
-                        if self._should_forward(event.message, rule):
-                            await self._forward_message(event.message, rule, is_edit=True)
-                    except Exception as e:
-                        self.logger.error(f"Error forwarding edited message: {str(e)}", exc_info=True)
+            self.metrics.inc('edits_received_total', source=event.chat_id)
+            if edits.add(event.message):
+                self.metrics.inc('edits_coalesced_total', source=event.chat_id)
+
+        # Only handle chats that currently have rules
+        self.client.add_event_handler(
+            handler, events.NewMessage(func=lambda event: event.chat_id in self.rule_index.by_source)
+        )
+        self.client.add_event_handler(
+            edit_handler, events.MessageEdited(func=lambda event: event.chat_id in self.rule_index.edits_by_source)
+        )
+
+        recovery = asyncio.ensure_future(self._recover(rule_index)) if self.outbox is not None else None
+        reload_interval = self.config.get('config_reload_interval', 2)
+        watcher = asyncio.ensure_future(self._watch_config(reload_interval)) if reload_interval else None
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self._try_reload()))
+            reload_on_sighup = True
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+            # No SIGHUP on Windows, or not running in the main thread
+            reload_on_sighup = False
 
         self.logger.info(self.translate("Listening for new messages...", self.language))
-        await self.client.run_until_disconnected()
+        try:
+            await self.client.run_until_disconnected()
+        finally:
+            if reload_on_sighup:
+                loop.remove_signal_handler(signal.SIGHUP)
+            if watcher is not None:
+                watcher.cancel()
+            if recovery is not None:
+                recovery.cancel()
+            await self._close_pipeline()
 
-    def _should_forward(self, message, rule):
-        # Existing conditions
-        basic_conditions = super()._should_forward(message, rule)
-        
-        # New date/time filter
-        if 'time_range' in rule:
-            message_time = message.date.time()
-            start_time = datetime.strptime(rule['time_range']['start'], "%H:%M").time()
-            end_time = datetime.strptime(rule['time_range']['end'], "%H:%M").time()
-            time_condition = start_time <= message_time <= end_time
+    async def reload_rules(self):
+        # Reads the forwarding rules from config.json again and swaps them in.
+        # A config that cannot be read or has an invalid rule is rejected and
+        # the current rules stay in place.
+        async with self.reload_lock:
+            try:
+                with open(self.config_path, "r") as file:
+                    forward_rules = json.load(file).get('forward_rules', [])
+                validate_rules(forward_rules)
+                if not forward_rules:
+                    raise ValueError("no forwarding rules")
+                rule_index = RuleIndex(forward_rules, self.rule_index)
+            except (OSError, ValueError, AttributeError) as e:
+                self.metrics.inc('config_reloads_total', result='rejected')
+                self.logger.error(f"Rejected the new {self.config_path}, keeping the current rules: {str(e)}")
+                return False
+
+            new_peers = self._rule_peers(forward_rules) - self._rule_peers(self.rule_index.rules)
+            try:
+                if new_peers:
+                    for account in self.pool.accounts:
+                        await account.peers.warm_up(new_peers)
+            except Exception as e:
+                # Connection trouble, flood waits and RPC errors while
+                # resolving the new chats
+                self.metrics.inc('config_reloads_total', result='rejected')
+                self.logger.error(f"Could not resolve the chats of the new {self.config_path}, keeping the current "
+                                  f"rules until the next change: {str(e)}", exc_info=True)
+                return False
+            self.rule_index = rule_index
+            self.config['forward_rules'] = forward_rules
+            self.metrics.inc('config_reloads_total', result='applied')
+            self.logger.info(
+                f"Reloaded {len(forward_rules)} forwarding rules, recompiled the rules of {rule_index.recompiled} chats"
+            )
+            return True
+
+    def _config_mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return None
+
+    async def _watch_config(self, interval):
+        # Polling the modification time also catches editors that replace
+        # the file instead of writing to it
+        last_mtime = self._config_mtime()
+        while True:
+            await asyncio.sleep(interval)
+            mtime = self._config_mtime()
+            if mtime is not None and mtime != last_mtime:
+                last_mtime = mtime
+                await self._try_reload()
+
+    async def _try_reload(self):
+        # A reload that fails unexpectedly is logged and leaves the watcher
+        # and the signal handler working for the next change
+        try:
+            await self.reload_rules()
+        except Exception as e:
+            self.logger.error(f"Error reloading {self.config_path}: {str(e)}", exc_info=True)
+
+    async def backfill(self, forward_rules, source_chat_ids, limit=100):
+        # Forwards the last `limit` messages of the given sources through
+        # their rules, e.g. after adding a rule for a new source
+        await self.client.connect()
+
+        # Ensure you're authorized
+        if not await self.client.is_user_authorized():
+            await self.client.send_code_request(self.phone_number)
+            await self.client.sign_in(self.phone_number, input(self.translate('Enter the code: ', self.language)))
+
+        rule_index = self.rule_index = RuleIndex(forward_rules)
+        await self._open_pipeline(forward_rules)
+        try:
+            for source_chat_id in source_chat_ids:
+                if not rule_index.rules_for(source_chat_id):
+                    self.logger.warning(f"No forwarding rules for chat {source_chat_id}, skipping backfill")
+                    continue
+                source = await retry_flood_waits(lambda: self.peers.get(source_chat_id), self.logger,
+                                                 f"Backfill of chat {source_chat_id}")
+                boundary = await retry_flood_waits(
+                    lambda: self.client.get_messages(source, limit=1, add_offset=limit), self.logger,
+                    f"Backfill of chat {source_chat_id}"
+                )
+                min_id = boundary[0].id if boundary else 0
+                await self._process_history(rule_index, source_chat_id, min_id, label="Backfill")
+        finally:
+            await self._close_pipeline()
+
+    def _rule_peers(self, forward_rules):
+        peer_ids = set()
+        for rule in forward_rules:
+            peer_ids.add(rule['source_chat_id'])
+            peer_ids.update(rule['destination_channels'])
+        return peer_ids
+
+    async def _open_pipeline(self, forward_rules):
+        peer_ids = self._rule_peers(forward_rules)
+        for account in self.pool.accounts:
+            if account is not self.primary:
+                await account.client.connect()
+                if not await account.client.is_user_authorized():
+                    await account.client.send_code_request(account.name)
+                    code = input(f"{account.name}: " + self.translate('Enter the code: ', self.language))
+                    await account.client.sign_in(account.name, code)
+            # Flood waits of sends are handled by the send scheduler, which
+            # retries the send without holding back the other destinations;
+            # the other requests sleep them out with retry_flood_waits
+            account.client.flood_sleep_threshold = 0
+            await account.peers.warm_up(peer_ids)
+        if self.config.get('sender_processes', False):
+            self.senders = SenderProcesses(
+                self.config['accounts'], self.config, peer_ids, self.client_factory,
+                self.config.get('sharding', 'hash'), self.config.get('sender_queue_size', 1000), self.logger
+            )
+            self.senders.start()
+        if self.config.get('outbox', True):
+            self.outbox = Outbox(self.config.get('outbox_path', f"outbox_{self.phone_number}.db"))
+            self.outbox.start()
+        metrics_config = self.metrics_config
+        if metrics_config.get('port'):
+            host = metrics_config.get('host', '127.0.0.1')
+            self.metrics_server = await self.metrics.serve(host, metrics_config['port'])
+            self.logger.info(f"Serving metrics on http://{host}:{metrics_config['port']}/metrics")
+        if metrics_config.get('stats_interval'):
+            self.stats_reporter = asyncio.ensure_future(self._report_stats(metrics_config['stats_interval']))
+
+    async def _close_pipeline(self):
+        if self.stats_reporter is not None:
+            self.stats_reporter.cancel()
+            self.stats_reporter = None
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+            self.metrics_server = None
+        if self.senders is not None:
+            await self.senders.stop()
+            self.senders = None
+        await self.scheduler.stop()
+        for account in self.pool.accounts:
+            account.peers.save()
+            if account is not self.primary:
+                await account.client.disconnect()
+        if self.outbox is not None:
+            await self.outbox.close()
+            self.outbox = None
+        self.catching_up = {}
+        self.unfinished = {}
+        self.finished = {}
+        self.live_from = {}
+        self.recovered_ids = {}
+
+    async def _report_stats(self, interval):
+        previous = {}
+        while True:
+            await asyncio.sleep(interval)
+            totals = self.metrics.totals()
+            delta = {name: value - previous.get(name, 0) for name, value in totals.items()}
+            previous = totals
+
+            def average(name):
+                count = delta.get(name + '_count', 0)
+                return delta.get(name + '_sum', 0) / count if count else 0.0
+
+            scheduler = self.scheduler.stats()
+            self.logger.info(
+                f"Stats for the last {interval}s: {delta.get('messages_received_total', 0)} received, "
+                f"{delta.get('messages_matched_total', 0)} matched, {delta.get('messages_forwarded_total', 0)} "
+                f"forwarded, {delta.get('messages_failed_total', 0)} failed, "
+                f"{delta.get('duplicates_skipped_total', 0)} duplicates skipped, {delta.get('flood_waits_total', 0)} "
+                f"flood waits, {self.scheduler.queue_depth} sends queued ({scheduler['parked']} parked, "
+                f"{scheduler['deferred']} deferred), avg filter {average('filter_seconds') * 1000:.2f}ms, avg send "
+                f"{average('send_seconds'):.2f}s, avg lag {average('lag_seconds'):.2f}s, queue wait avg "
+                f"{scheduler['avg_queue_wait']:.2f}s max {scheduler['max_queue_wait']:.2f}s"
+            )
+            if scheduler['blocked_destinations']:
+                blocked = ', '.join(
+                    f"{destination} ({seconds}s)" for destination, seconds in scheduler['blocked_destinations'].items()
+                )
+                self.logger.info(f"Destinations waiting out a flood wait: {blocked}")
+            if self.senders is not None:
+                senders = ', '.join(
+                    f"{name} {'running' if sender['alive'] else 'stopped'} ({sender['in_flight']} in flight, "
+                    f"{sender['sent']} sent)"
+                    for name, sender in self.senders.stats().items()
+                )
+                self.logger.info(f"Sender processes: {senders}")
+
+    def _receive(self, message):
+        # Returns False for a live message that the catch-up of its source
+        # already took. Otherwise the catch-up stops short of it, so that each
+        # message is forwarded by exactly one of them.
+        if self.outbox is None:
+            return True
+        source_chat_id = message.chat_id
+        if message.id <= self.recovered_ids.get(source_chat_id, 0):
+            return False
+        if source_chat_id in self.catching_up:
+            self.live_from[source_chat_id] = min(self.live_from.get(source_chat_id, message.id), message.id)
+        self.unfinished.setdefault(source_chat_id, set()).add(message.id)
+        return True
+
+    def _checkpoint(self, messages):
+        # Called once the messages went through the filters and every send
+        # was recorded in the ledger (or skipped). The checkpoint never moves
+        # past a message that is still buffered, waiting for approval or
+        # being sent, so a crash leaves it to the next catch-up.
+        if self.outbox is None:
+            return
+        source_chat_id = messages[0].chat_id
+        unfinished = self.unfinished.get(source_chat_id, set())
+        unfinished.difference_update(message.id for message in messages)
+        finished = max(self.finished.get(source_chat_id, 0), max(message.id for message in messages))
+        self.finished[source_chat_id] = finished
+        last_id = min(finished, min(unfinished) - 1) if unfinished else finished
+        if source_chat_id in self.catching_up:
+            # Held back until the catch-up of this source is done, so that a
+            # crash in between does not skip the rest of the gap
+            self.catching_up[source_chat_id] = max(self.catching_up[source_chat_id], last_id)
         else:
-            time_condition = True
-        
-        return basic_conditions and time_condition
-
-    async def _forward_message(self, message, rule, is_edit=False):
-        for dest_channel in rule['destination_channels']:
-            scheduled_time = self._get_scheduled_time(rule)
-            prefix = rule.get('prefix', '')
-            suffix = rule.get('suffix', '')
-            
-            # Process the message text
-            processed_text = self._process_message_text(message.text, rule)
-            forwarded_text = f"{prefix}{processed_text}{suffix}"
-
-            # Generate preview
-            preview = self._generate_preview(forwarded_text, message)
-            print("\n" + self.translate("Message Preview:", self.language))
-            print(preview)
+            self.outbox.advance(source_chat_id, last_id)
+
+    async def _dispatch(self, rule_index, messages, priority=0, recovering=False):
+        # Rules are forwarded concurrently so that a rule waiting for approval
+        # does not hold back the others. An album goes to every rule matched
+        # by any of its items, usually the one carrying the caption.
+        # recovering is set for messages read from the history, which may
+        # already have been delivered before a restart.
+        self.metrics.inc('messages_received_total', len(messages), source=messages[0].chat_id)
+        start = time.perf_counter()
+        rules = {}
+        for message in messages:
+            for rule in rule_index.match(message.chat_id, message):
+                rules.setdefault(id(rule), rule)
+        elapsed = time.perf_counter() - start
+        self.metrics.observe('filter_seconds', elapsed)
+        self.metrics.record_stage('filter', elapsed)
+        for rule in rules.values():
+            self.metrics.inc('messages_matched_total', rule=rule_label(rule))
+        await asyncio.gather(*(
+            self._forward(messages, rule, priority=priority, recovering=recovering) for rule in rules.values()
+        ))
+
+    async def _recover(self, rule_index):
+        await self._replay_outbox(rule_index)
+        await self._catch_up(rule_index)
+
+    async def _catch_up(self, rule_index):
+        # A source whose catch-up fails is retried from the last batch that
+        # was processed, and its live checkpoints stay held back until then,
+        # so neither a retry nor a restart skips the rest of the gap
+        pending = list(self.catching_up)
+        retry_delay = self.config.get('catch_up_retry_delay', 5)
+        while pending:
+            failed = []
+            for source_chat_id in pending:
+                try:
+                    last_id = self.outbox.last_message_id(source_chat_id)
+                    source = await retry_flood_waits(
+                        lambda: self.peers.get(source_chat_id), self.logger, f"Catch-up of chat {source_chat_id}"
+                    )
+                    latest = await retry_flood_waits(
+                        lambda: self.client.get_messages(source, limit=1), self.logger,
+                        f"Catch-up of chat {source_chat_id}"
+                    )
+                    if latest and latest[0].id > last_id:
+                        await self._process_history(rule_index, source_chat_id, last_id, latest[0].id + 1, "Catch-up")
+                except Exception as e:
+                    self.logger.error(f"Error catching up on chat {source_chat_id}, retrying in {retry_delay} seconds: "
+                                      f"{str(e)}", exc_info=True)
+                    failed.append(source_chat_id)
+                else:
+                    self.outbox.advance(source_chat_id, self.catching_up.pop(source_chat_id))
+            pending = failed
+            if pending:
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 300)
+
+    async def _process_history(self, rule_index, source_chat_id, min_id=0, max_id=0, label="Catch-up"):
+        # Streams the messages between min_id and max_id oldest first and
+        # feeds them through the regular filters and send scheduler. Only the
+        # current album is held in memory, and each batch is sent before the
+        # next one is read, so the backlog is paced by the rate limiter.
+        delay = self.config.get('catch_up_delay', 0)
+        priority = self.config.get('catch_up_priority', 10)
+        processed = 0
+        last_id = min_id
+        batch = []
+        reached_live = False
+
+        async def flush_batch():
+            nonlocal processed, reached_live
+            if source_chat_id in self.catching_up:
+                # Messages from the first live one on are left to the live
+                # handler, and the live handler leaves the ones taken here
+                live_from = self.live_from.get(source_chat_id)
+                if live_from is not None and batch[-1].id >= live_from:
+                    reached_live = True
+                    batch[:] = [message for message in batch if message.id < live_from]
+                    if not batch:
+                        return
+                self.recovered_ids[source_chat_id] = batch[-1].id
+            await self._dispatch(rule_index, batch, priority, recovering=True)
+            processed += len(batch)
+            if self.outbox is not None:
+                self.outbox.advance(source_chat_id, batch[-1].id)
+            if processed // 100 != (processed - len(batch)) // 100:
+                self.logger.info(f"{label} of chat {source_chat_id}: {processed} messages processed (last ID {batch[-1].id})")
+            batch.clear()
+            if delay:
+                await asyncio.sleep(delay)
+
+        self.logger.info(f"{label} of chat {source_chat_id} starting after message {min_id}")
+        source = await retry_flood_waits(lambda: self.peers.get(source_chat_id), self.logger,
+                                         f"{label} of chat {source_chat_id}")
+        while True:
+            try:
+                async for message in self.client.iter_messages(source, min_id=last_id, max_id=max_id, reverse=True):
+                    if batch and not (message.grouped_id and message.grouped_id == batch[-1].grouped_id):
+                        await flush_batch()
+                        if reached_live:
+                            break
+                    batch.append(message)
+                    last_id = message.id
+                break
+            except FloodWaitError as e:
+                self.logger.warning(f"{label} of chat {source_chat_id} rate limited, resuming in {e.seconds} seconds")
+                await asyncio.sleep(e.seconds)
+                # The current album is re-read after the wait
+                if batch:
+                    last_id = batch[0].id - 1
+                    batch.clear()
+        if batch and not reached_live:
+            await flush_batch()
+        self.logger.info(f"{label} of chat {source_chat_id} finished: {processed} messages processed")
+
+    async def _forward(self, messages, rule, is_edit=False, destinations=None, priority=0, recovering=False):
+        try:
+            if len(messages) > 1:
+                await self._forward_album(messages, rule, destinations, priority, recovering)
+            else:
+                await self._forward_message(messages[0], rule, is_edit, destinations, priority, recovering)
+        except Exception as e:
+            action = "edited message" if is_edit else "message"
+            self.logger.error(f"Error forwarding {action}: {str(e)}", exc_info=True)
 
-            # Ask for confirmation
-            confirm = input(self.translate("Send this message? (y/n): ", self.language)).lower().strip()
-            if confirm != 'y':
-                print(self.translate("Message sending cancelled.", self.language))
+    async def _replay_outbox(self, rule_index):
+        # Sends that were still pending when the process stopped
+        pending = {}
+        for source_chat_id, message_id, dest_channel in self.outbox.pending():
+            pending.setdefault(source_chat_id, {}).setdefault(message_id, set()).add(dest_channel)
+        for source_chat_id, destinations_by_message in pending.items():
+            rules = rule_index.rules_for(source_chat_id)
+            async def fetch():
+                source = await self.peers.get(source_chat_id)
+                return await self.client.get_messages(source, ids=list(destinations_by_message))
+
+            try:
+                messages = await retry_flood_waits(fetch, self.logger, f"Fetching pending messages from {source_chat_id}")
+            except Exception as e:
+                self.logger.error(f"Error fetching pending messages from {source_chat_id}: {str(e)}", exc_info=True)
                 continue
+            batches = {}
+            for message_id, message in zip(destinations_by_message, messages):
+                if message is None or not rules:
+                    # Deleted since, or its rule was removed
+                    for dest_channel in destinations_by_message[message_id]:
+                        self.outbox.mark(source_chat_id, [message_id], dest_channel, Outbox.FAILED)
+                    continue
+                batches.setdefault(message.grouped_id or ('message', message.id), []).append(message)
+            for batch in batches.values():
+                destinations = set()
+                for message in batch:
+                    destinations |= destinations_by_message[message.id]
+                self.logger.info(f"Replaying {len(batch)} pending message(s) from {source_chat_id} to {sorted(destinations)}")
+                for rule in rules:
+                    rule_destinations = [d for d in rule['destination_channels'] if d in destinations]
+                    if rule_destinations:
+                        await self._forward(batch, rule, destinations=rule_destinations, recovering=True)
+
+    async def _forward_message(self, message, rule, is_edit=False, destinations=None, priority=0, recovering=False):
+        destinations = self._undelivered_destinations([message], rule, destinations, recovering)
+        content, destinations = self._claim_content([message], rule, destinations, f"message {message.id}", is_edit)
+        if not destinations:
+            return
+        unsent = destinations
+        try:
+            forwarded_text = self._format_text(message, rule)
+
+            if self.require_approval:
+                with self.metrics.stage('preview'):
+                    preview = self._generate_preview(forwarded_text, message)
+                if not await self.approvals.request(preview, destinations):
+                    print(self.translate("Message sending cancelled.", self.language))
+                    return
+
+            action = "edit forwarded" if is_edit else "forwarded"
+            unsent = await self._fan_out(
+                [message], [forwarded_text], rule, destinations, f"message {message.id}", action, priority,
+                not is_edit, is_edit
+            )
+        finally:
+            self._release_content(content, unsent)
+
+    async def _forward_album(self, messages, rule, destinations=None, priority=0, recovering=False):
+        destinations = self._undelivered_destinations(messages, rule, destinations, recovering)
+        ids = ', '.join(str(message.id) for message in messages)
+        content, destinations = self._claim_content(messages, rule, destinations, f"album {ids}")
+        if not destinations:
+            return
+        unsent = destinations
+        try:
+            with self.metrics.stage('text'):
+                pipeline = self._pipeline(rule)
+                captions = [pipeline.apply(message.raw_text, message.entities) for message in messages]
+            # The album caption is shown from the first captioned item, so that
+            # is the one that gets the prefix and suffix
+            first = next((i for i, caption in enumerate(captions) if caption), 0)
+            captions[first] = pipeline.frame(captions[first])
+
+            if self.require_approval:
+                with self.metrics.stage('preview'):
+                    preview = self._generate_preview(captions[first], messages[first])
+                preview = f"[Album: {len(messages)} items]\n" + preview
+                if not await self.approvals.request(preview, destinations):
+                    print(self.translate("Message sending cancelled.", self.language))
+                    return
+
+            unsent = await self._fan_out(messages, captions, rule, destinations, f"album {ids}", "forwarded", priority)
+        finally:
+            self._release_content(content, unsent)
+
+    def _claim_content(self, messages, rule, destinations, label, is_edit=False):
+        # Drops the destinations that already received the same content from
+        # another source, before anything is formatted or sent. Edits go to
+        # the copies they belong to and are never deduplicated.
+        if self.dedup is None or is_edit or not destinations:
+            return None, destinations
+        content = self.dedup.signature(messages)
+        if content is None:
+            return None, destinations
+        fresh = []
+        for dest_channel in destinations:
+            if self.dedup.claim(dest_channel, content):
+                fresh.append(dest_channel)
+            else:
+                self.metrics.inc('duplicates_skipped_total', rule=rule_label(rule), destination=dest_channel)
+                self.logger.info(f"Skipping {label}: another source already sent the same content to channel "
+                                 f"{dest_channel}")
+        return content, fresh
 
+    def _release_content(self, content, destinations):
+        # Destinations the content was claimed for but not delivered to
+        if content is not None:
+            for dest_channel in destinations:
+                self.dedup.forget(dest_channel, content)
+
+    def _undelivered_destinations(self, messages, rule, destinations=None, recovering=False):
+        # Only messages read back from the history or the ledger can have
+        # been delivered already, live ones skip the lookup
+        if destinations is None:
+            destinations = rule['destination_channels']
+        if self.outbox is None or not recovering:
+            return list(destinations)
+        source_chat_id = messages[0].chat_id
+        message_ids = [message.id for message in messages]
+        undelivered = []
+        for dest_channel in destinations:
+            if self.outbox.is_delivered(source_chat_id, message_ids, dest_channel):
+                self.logger.info(f"Skipping messages {message_ids} already delivered to channel {dest_channel}")
+            else:
+                undelivered.append(dest_channel)
+        return undelivered
+
+    async def _fan_out(self, messages, captions, rule, destinations, label, action, priority=0, record=True,
+                       is_edit=False):
+        scheduled_time = self._get_scheduled_time(rule)
+        native = self._can_forward_natively(messages, rule)
+        # Media is resolved to InputMedia once per account and the same file
+        # references are reused for every destination
+        media_by_account = {}
+
+        async def media_for(account):
+            if account.name not in media_by_account:
+                media_by_account[account.name] = asyncio.ensure_future(self._account_media(account, messages, rule))
+            return await media_by_account[account.name]
+
+        async def send(account, peer, edit_id=None):
+            with self.metrics.stage('send'):
+                return await self._deliver(
+                    account, peer, messages, captions, native, scheduled_time, media_for, edit_id
+                )
+
+        # The same send as a picklable work item for the sender processes
+        work = {
+            'source_chat_id': messages[0].chat_id,
+            'message_ids': [message.id for message in messages],
+            'has_media': any(message.media for message in messages),
+            'captions': captions,
+            'native': native,
+            'scheduled_time': scheduled_time,
+            'rule': {'include_media': rule.get('include_media', True)},
+        }
+
+        # Fan out to every destination at once through the send scheduler and
+        # return the destinations that could not be reached
+        delivered = await asyncio.gather(*(
+            self._send_to_destination(messages, dest_channel, send, work, rule, label, action, scheduled_time,
+                                      priority, record, is_edit)
+            for dest_channel in destinations
+        ))
+        return [dest_channel for dest_channel, ok in zip(destinations, delivered) if not ok]
+
+    async def _deliver_work(self, work):
+        # Sender process side of _fan_out. Only IDs and the formatted captions
+        # cross the process boundary, so this account reads the messages again
+        # when it needs their media, once for all destinations.
+        messages = [
+            SimpleNamespace(id=message_id, chat_id=work['source_chat_id'], media=work['has_media'])
+            for message_id in work['message_ids']
+        ]
+        key = (work['source_chat_id'], tuple(work['message_ids']))
+
+        async def media_for(account):
+            if key not in self.fetched_media:
+                self.fetched_media[key] = asyncio.ensure_future(
+                    self._account_media(account, messages, work['rule'], fetch=True)
+                )
+                while len(self.fetched_media) > 256:
+                    self.fetched_media.popitem(last=False)
             try:
-                if scheduled_time:
-                    await self.client.send_message(dest_channel, forwarded_text, schedule=scheduled_time)
-                    self.logger.info(f"Message scheduled for {scheduled_time} to channel {dest_channel}")
-                else:
-                    if rule.get('include_media', True) and message.media:
-                        await self.client.send_file(dest_channel, message.media, caption=forwarded_text)
-                    else:
-                        await self.client.send_message(dest_channel, forwarded_text)
-                    
-                    action = "forwarded" if not is_edit else "edit forwarded"
-                    self.logger.info(f"Message {action}: {message.id} to channel {dest_channel}")
+                return await self.fetched_media[key]
+            except Exception:
+                self.fetched_media.pop(key, None)
+                raise
+
+        async def send(account, peer):
+            return await self._deliver(
+                account, peer, messages, work['captions'], work['native'], work['scheduled_time'], media_for,
+                work.get('edit_id')
+            )
+
+        sent = await self.scheduler.submit(work['dest_channel'], self._with_peer(send), work['priority'])
+        return [message.id for message in sent if message is not None]
+
+    async def _account_media(self, account, messages, rule, fetch=False):
+        if ((fetch or account is not self.primary) and rule.get('include_media', True)
+                and any(message.media for message in messages)):
+            # File references are only valid for the account that fetched the
+            # message, so other accounts read it themselves
+            source = await account.peers.get(messages[0].chat_id)
+            fetched = await account.client.get_messages(source, ids=[message.id for message in messages])
+            if any(message is None for message in fetched):
+                raise ValueError(f"Account {account.name} cannot read messages from chat {messages[0].chat_id}")
+            messages = fetched
+        return [self._resolve_media(message, rule) for message in messages]
+
+    async def _deliver(self, account, peer, messages, captions, native, scheduled_time, media_for, edit_id=None):
+        client = account.client
+        if edit_id is not None:
+            # Edit the copy sent earlier instead of posting a new one. Copies
+            # are always sent as messages of their own, so the formatted text
+            # applies to a native forward as well.
+            caption = captions[0]
+            try:
+                return [await client.edit_message(
+                    peer, edit_id, caption.text, formatting_entities=caption.entities, parse_mode=None
+                )]
+            except MessageNotModifiedError:
+                return []
+            except (MessageIdInvalidError, MessageAuthorRequiredError, MessageEditTimeExpiredError):
+                # The copy was deleted or can no longer be edited, post the
+                # edited version as a new message
+                pass
+        if native:
+            try:
+                source = await account.peers.get(messages[0].chat_id)
+            except ValueError:
+                # Only members can forward from the source, other accounts
+                # send a copy instead
+                source = None
+            if source is not None:
+                try:
+                    return await client.forward_messages(
+                        peer, [message.id for message in messages], source, drop_author=True, schedule=scheduled_time
+                    )
+                except (ChatForwardsRestrictedError, ChannelPrivateError):
+                    pass
+
+        # Entities are passed as they are, with the parse mode off so that
+        # the text is never parsed as markdown again
+        items = list(zip(await media_for(account), captions))
+        album = [(media, caption) for media, caption in items if media is not None]
+        text = FormattedText.join([caption for media, caption in items if media is None and caption])
+        sent = []
+        if len(album) == 1:
+            media, caption = album[0]
+            sent.append(await client.send_file(
+                peer, media, caption=caption.text, formatting_entities=caption.entities, parse_mode=None,
+                schedule=scheduled_time
+            ))
+        elif album:
+            sent.extend(await client.send_file(
+                peer, [media for media, _ in album], caption=[caption.text for _, caption in album],
+                formatting_entities=[caption.entities for _, caption in album], parse_mode=None,
+                schedule=scheduled_time
+            ))
+        if text:
+            sent.append(await client.send_message(
+                peer, text.text, formatting_entities=text.entities, parse_mode=None, schedule=scheduled_time
+            ))
+        if not sent:
+            raise ValueError("Nothing to send: no text and no media that can be sent")
+        return sent
+
+    async def _send_to_destination(self, messages, dest_channel, send, work, rule, label, action, scheduled_time=None,
+                                   priority=0, record=True, is_edit=False):
+        ledger = self.outbox if record else None
+        source_chat_id = messages[0].chat_id
+        message_ids = [message.id for message in messages]
+        key = (source_chat_id, message_ids[0], dest_channel)
+        previous = self.deliveries.get(key)
+        delivered = self.deliveries[key] = asyncio.get_running_loop().create_future()
+        try:
+            if is_edit and previous is not None:
+                # The message or an earlier edit is still on its way, the edit
+                # goes to the copy it ends up in
+                await asyncio.wait([previous])
+            return await self._send_copy(
+                messages, dest_channel, send, work, rule, label, action, scheduled_time, priority, ledger, is_edit
+            )
+        finally:
+            delivered.set_result(None)
+            if self.deliveries.get(key) is delivered:
+                del self.deliveries[key]
+
+    async def _send_copy(self, messages, dest_channel, send, work, rule, label, action, scheduled_time, priority,
+                         ledger, is_edit):
+        source_chat_id = messages[0].chat_id
+        message_ids = [message.id for message in messages]
+        if ledger is not None:
+            ledger.mark(source_chat_id, message_ids, dest_channel, Outbox.PENDING)
+        copy = self._copy_of(source_chat_id, message_ids[0], dest_channel) if is_edit and not scheduled_time else None
+        account = None
+        if copy is not None:
+            # Only the account that sent the copy can edit it
+            account, edit_id = copy
+            send = functools.partial(send, edit_id=edit_id)
+            work = dict(work, edit_id=edit_id)
+            action = "edit applied"
+        start = time.monotonic()
+        try:
+            sender, sent_ids = await self._submit(dest_channel, send, work, priority, account)
+            copy_ids = None
+            if copy is not None and sent_ids == [copy[1]]:
+                self.metrics.inc('edits_applied_total', destination=dest_channel)
+            elif copy is not None and not sent_ids:
+                action = "edit unchanged"
+            else:
+                if copy is not None:
+                    # The copy could no longer be edited and was sent again
+                    action = "edit forwarded"
+                if not scheduled_time and self._remember_copies(
+                        source_chat_id, message_ids, dest_channel, sender, sent_ids):
+                    copy_ids = sent_ids
+            if self.outbox is not None and (ledger is not None or copy_ids):
+                self.outbox.mark(source_chat_id, message_ids, dest_channel, Outbox.SENT, copy_ids, sender)
+            self.metrics.inc('messages_forwarded_total', rule=rule_label(rule), destination=dest_channel)
+            self.metrics.observe('send_seconds', time.monotonic() - start)
+            posted = messages[0].edit_date or messages[0].date
+            if posted is not None and not scheduled_time:
+                self.metrics.observe('lag_seconds', time.time() - posted.timestamp())
+            if scheduled_time:
+                self.logger.info(f"{label.capitalize()} scheduled for {scheduled_time} to channel {dest_channel}")
+            else:
+                self.logger.info(f"{label.capitalize()} {action} to channel {dest_channel}")
+            return True
+        except Exception as e:
+            if ledger is not None:
+                ledger.mark(source_chat_id, message_ids, dest_channel, Outbox.FAILED)
+            self.metrics.inc('messages_failed_total', rule=rule_label(rule), destination=dest_channel)
+            self.logger.error(f"Failed to forward {label} to channel {dest_channel}: {str(e)}", exc_info=True)
+            return False
+
+    async def _submit(self, dest_channel, send, work, priority=0, account=None):
+        # Returns the name of the account that sent to the destination and the
+        # IDs of the messages it sent there
+        if self.senders is not None:
+            return await self.senders.submit(dest_channel, work, priority, account)
+        sender = None
+
+        async def send_with(account, peer):
+            nonlocal sender
+            sender = account.name
+            return await send(account, peer)
+
+        sent = await self.scheduler.submit(dest_channel, self._with_peer(send_with), priority, account)
+        return sender, [message.id for message in sent if message is not None]
+
+    def _copy_of(self, source_chat_id, message_id, dest_channel):
+        # (account name, message ID) of the copy of a message in a destination
+        copy = self.copies.get(source_chat_id, message_id, dest_channel)
+        if copy is None and self.outbox is not None:
+            copy = self.outbox.copy_of(source_chat_id, message_id, dest_channel)
+            if copy is not None:
+                self.copies.put(source_chat_id, message_id, dest_channel, *copy)
+        return copy
+
+    def _remember_copies(self, source_chat_id, message_ids, dest_channel, account, sent_ids):
+        # Copies are only mapped one to one, a message whose text was split
+        # off an album or dropped cannot be matched to its copy
+        if account is None or len(sent_ids) != len(message_ids):
+            return False
+        for message_id, copy_id in zip(message_ids, sent_ids):
+            self.copies.put(source_chat_id, message_id, dest_channel, account, copy_id)
+        return True
+
+    def _with_peer(self, send):
+        # Sends address destinations by the account's cached InputPeer instead
+        # of a bare ID that Telethon would have to resolve again
+        async def send_to_peer(account, dest_channel):
+            try:
+                return await send(account, await account.peers.get(dest_channel))
+            except (ChannelInvalidError, PeerIdInvalidError):
+                # Stale access hash, resolve it again next time
+                account.peers.invalidate(dest_channel)
+                raise
+        return send_to_peer
+
+    async def serve_sends(self, jobs, results, peer_ids):
+        # Main loop of a sender process: takes work items from the receiver
+        # and reports (id, sent message IDs, error) for each of them
+        await self.client.connect()
+        if not await self.client.is_user_authorized():
+            raise RuntimeError(f"Account {self.phone_number} is not logged in, "
+                               f"run once without sender_processes to log it in")
+        self.client.flood_sleep_threshold = 0
+        await self.peers.warm_up(peer_ids)
+
+        loop = asyncio.get_running_loop()
+        # Only take as much work as can be in progress, the rest stays in the
+        # bounded queue and holds the receiver back
+        prefetch = asyncio.Semaphore(self.config.get('sender_prefetch', 100))
+        tasks = set()
+
+        async def serve(work):
+            try:
+                sent = await self._deliver_work(work)
             except Exception as e:
-                self.logger.error(f"Failed to forward message {message.id}: {str(e)}", exc_info=True)
+                results.put((work['id'], None, f"{type(e).__name__}: {e}"))
+            else:
+                results.put((work['id'], sent, None))
+            finally:
+                prefetch.release()
 
-    def _process_message_text(self, text, rule):
-        if rule.get('remove_links', False):
-            # Remove URLs from the text
-            text = re.sub(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', '', text)
-        
-        # Add more text processing options here if needed
-        
-        return text.strip()
+        try:
+            while True:
+                await prefetch.acquire()
+                work = await loop.run_in_executor(None, jobs.get)
+                if work is None:
+                    break
+                task = asyncio.ensure_future(serve(work))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            await self.scheduler.stop()
+            self.peers.save()
+            await self.client.disconnect()
+
+    def _can_forward_natively(self, messages, rule):
+        # A native forward (without the author header) sends the original
+        # message as is, so it only applies when the text is left untouched
+        if not rule.get('native_forward', True):
+            return False
+        if rule.get('prefix') or rule.get('suffix') or rule.get('remove_links', False):
+            return False
+        if not rule.get('include_media', True) and any(message.media for message in messages):
+            return False
+        return True
+
+    def _resolve_media(self, message, rule):
+        if not (rule.get('include_media', True) and message.media):
+            return None
+        try:
+            return utils.get_input_media(message.media)
+        except TypeError:
+            # Web page previews and similar media cannot be sent as files
+            return None
+
+    def _pipeline(self, rule):
+        # The rule's compiled text pipeline, or a new one when the forwarder
+        # is driven without a rule index
+        if self.rule_index is None:
+            return TextPipeline(rule)
+        return self.rule_index.pipeline(rule)
+
+    def _format_text(self, message, rule):
+        with self.metrics.stage('text'):
+            pipeline = self._pipeline(rule)
+            return pipeline.frame(pipeline.apply(message.raw_text, message.entities))
 
     def _get_scheduled_time(self, rule):
         if rule.get('schedule'):
@@ -147,26 +2595,10 @@ class TelegramForwarder:
             return scheduled_datetime
         return None
 
-    def _generate_preview(self, text, original_message):
-        preview = text
-
-        # Add formatting indicators
-        if original_message.entities:
-            for entity in original_message.entities:
-                if isinstance(entity, MessageEntityTextUrl):
-                    start = entity.offset
-                    end = entity.offset + entity.length
-                    url = entity.url
-                    preview = preview[:start] + f"[{preview[start:end]}]({url})" + preview[end:]
-                elif type(entity).__name__ == 'MessageEntityBold':
-                    start = entity.offset
-                    end = entity.offset + entity.length
-                    preview = preview[:start] + f"**{preview[start:end]}**" + preview[end:]
-                elif type(entity).__name__ == 'MessageEntityItalic':
-                    start = entity.offset
-                    end = entity.offset + entity.length
-                    preview = preview[:start] + f"*{preview[start:end]}*" + preview[end:]
-                # Add more formatting types as needed
+    def _generate_preview(self, formatted, original_message):
+        # The entities are those of the outgoing text, so their offsets
+        # already account for the prefix and removed links
+        preview = formatted.preview()
 
         # Add media indicator if present
         if original_message.media:
@@ -180,22 +2612,28 @@ class TelegramForwarder:
             self.logger.error(self.translate("User not authorized. Please run the forwarder first.", self.language))
             return
 
-        for rule in self.forward_rules:
+        dest_channels = []
+        for rule in self.config.get('forward_rules', []):
             for dest_channel in rule['destination_channels']:
-                try:
-                    channel = await self.client.get_entity(dest_channel)
-                    scheduled = await self.client(functions.messages.GetScheduledHistoryRequest(
-                        peer=channel,
-                        hash=0
-                    ))
-                    if scheduled.messages:
-                        print(f"\nScheduled messages for channel {dest_channel}:")
-                        for msg in scheduled.messages:
-                            print(f"ID: {msg.id}, Scheduled for: {msg.date}, Text: {msg.message[:50]}...")
-                    else:
-                        print(f"\nNo scheduled messages for channel {dest_channel}")
-                except Exception as e:
-                    self.logger.error(f"Error fetching scheduled messages for channel {dest_channel}: {str(e)}")
+                if dest_channel not in dest_channels:
+                    dest_channels.append(dest_channel)
+        await self.peers.warm_up(dest_channels)
+
+        for dest_channel in dest_channels:
+            try:
+                channel = await self.peers.get(dest_channel)
+                scheduled = await self.client(functions.messages.GetScheduledHistoryRequest(
+                    peer=channel,
+                    hash=0
+                ))
+                if scheduled.messages:
+                    print(f"\nScheduled messages for channel {dest_channel}:")
+                    for msg in scheduled.messages:
+                        print(f"ID: {msg.id}, Scheduled for: {msg.date}, Text: {msg.message[:50]}...")
+                else:
+                    print(f"\nNo scheduled messages for channel {dest_channel}")
+            except Exception as e:
+                self.logger.error(f"Error fetching scheduled messages for channel {dest_channel}: {str(e)}")
 
     async def delete_scheduled_message(self, channel_id, message_id):
         await self.client.connect()
@@ -204,12 +2642,13 @@ class TelegramForwarder:
             return
 
         try:
-            channel = await self.client.get_entity(channel_id)
+            channel = await self.peers.get(channel_id)
             await self.client(functions.messages.DeleteScheduledMessagesRequest(
                 peer=channel,
                 id=[message_id]
             ))
             print(f"Successfully deleted scheduled message {message_id} from channel {channel_id}")
+            self.peers.save()
         except Exception as e:
             self.logger.error(f"Error deleting scheduled message {message_id} from channel {channel_id}: {str(e)}")
 
@@ -237,6 +2676,23 @@ class TelegramForwarder:
         }
         return translations.get(language, translations['en']).get(text, text)
 
+def run_sender(account, config, peer_ids, jobs, results, client_factory=TelegramClient):
+    # Entry point of a sender process started by SenderProcesses
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    config = {
+        key: value for key, value in config.items()
+        if key not in ('accounts', 'sender_processes', 'peer_cache_path', 'outbox')
+    }
+
+    async def serve():
+        forwarder = TelegramForwarder(
+            account['api_id'], account['api_hash'], account['phone_number'], require_approval=False, config=config,
+            client_factory=client_factory
+        )
+        await forwarder.serve_sends(jobs, results, peer_ids)
+
+    asyncio.run(serve())
+
 # Function to read credentials from file
 def read_credentials():
     try:
@@ -257,18 +2713,51 @@ def write_credentials(api_id, api_hash, phone_number):
         file.write(api_hash + "\n")
         file.write(phone_number + "\n")
 
-def load_config():
+def write_chats(entries, output_format='text', output=None):
+    output = output or sys.stdout
+    if output_format == 'json':
+        json.dump(entries, output, ensure_ascii=False, indent=2)
+        output.write("\n")
+    elif output_format == 'csv':
+        writer = csv.DictWriter(output, fieldnames=['id', 'title', 'type', 'access_hash', 'top_message', 'date'])
+        writer.writeheader()
+        writer.writerows(entries)
+    else:
+        output.writelines(f"Chat ID: {entry['id']}, Title: {entry['title']}\n" for entry in entries)
+
+def load_config(path=CONFIG_PATH):
     try:
-        with open("config.json", "r") as file:
+        with open(path, "r") as file:
             return json.load(file)
     except FileNotFoundError:
         return {}
 
-def save_config(config):
-    with open("config.json", "w") as file:
+def save_config(config, path=CONFIG_PATH):
+    with open(path, "w") as file:
         json.dump(config, file, indent=2)
 
-async def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Forward messages between Telegram chats based on configurable rules.")
+    parser.add_argument('--headless', action='store_true',
+                        help="skip the menu and forward every matching message without asking for confirmation")
+    parser.add_argument('--language', choices=['en', 'es'], help="interface language")
+    parser.add_argument('--list-chats', action='store_true', help="list the account's chats and exit")
+    parser.add_argument('--search', metavar='TITLE',
+                        help="search the saved chat list by title without connecting to Telegram")
+    parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text',
+                        help="output format of --list-chats and --search (default: text)")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help="with --list-chats, fetch every chat instead of only the ones that changed")
+    parser.add_argument('--backfill', type=int, action='append', metavar='CHAT_ID',
+                        help="forward the recent history of a source chat through its rules and exit (repeatable)")
+    parser.add_argument('--backfill-limit', type=int, default=100, metavar='N',
+                        help="number of recent messages per chat to backfill (default: 100)")
+    return parser.parse_args(argv)
+
+async def main(args=None):
+    if args is None:
+        args = parse_args([])
+
     # Create logs directory if it doesn't exist
     logs_dir = 'logs'
     os.makedirs(logs_dir, exist_ok=True)
@@ -316,6 +2805,33 @@ async def main():
         # Write credentials to file for future use
         write_credentials(api_id, api_hash, phone_number)
 
+    if args.search is not None:
+        write_chats(DialogIndex(f"dialogs_of_{phone_number}.json").search(args.search), args.format)
+        return
+
+    if args.list_chats:
+        forwarder = TelegramForwarder(api_id, api_hash, phone_number, args.language or config.get('language', 'en'),
+                                      require_approval=False, config=config)
+        await forwarder.list_chats(args.format, args.full_refresh)
+        return
+
+    if args.backfill:
+        language = args.language or config.get('language', 'en')
+        forwarder = TelegramForwarder(api_id, api_hash, phone_number, language, require_approval=False, config=config)
+        await forwarder.backfill(config.get('forward_rules', []), args.backfill, args.backfill_limit)
+        return
+
+    # Headless daemon mode: no menu, no confirmation prompts
+    if args.headless or config.get('headless', False):
+        language = args.language or config.get('language', 'en')
+        forwarder = TelegramForwarder(api_id, api_hash, phone_number, language, require_approval=False, config=config)
+        forward_rules = config.get('forward_rules', [])
+        if not forward_rules:
+            logger.error(forwarder.translate("No forwarding rules found. Please add rules first.", language))
+            return
+        await forwarder.forward_messages_to_channels(forward_rules)
+        return
+
     # Define styles for prompt_toolkit
     style = Style.from_dict({
         'prompt': '#ansigreen bold',
@@ -323,14 +2839,17 @@ async def main():
     })
 
     # Language selection
-    language_completer = WordCompleter(['1', '2', 'English', 'Español'])
-    print(style_text("Select language / Seleccione el idioma:", 'title'))
-    print("1. English")
-    print("2. Español")
-    language_choice = prompt("Enter choice / Ingrese opción: ", completer=language_completer, style=style)
-    language = 'en' if language_choice in ['1', 'English'] else 'es'
-
-    forwarder = TelegramForwarder(api_id, api_hash, phone_number, language)
+    if args.language:
+        language = args.language
+    else:
+        language_completer = WordCompleter(['1', '2', 'English', 'Español'])
+        print(style_text("Select language / Seleccione el idioma:", 'title'))
+        print("1. English")
+        print("2. Español")
+        language_choice = prompt("Enter choice / Ingrese opción: ", completer=language_completer, style=style)
+        language = 'en' if language_choice in ['1', 'English'] else 'es'
+
+    forwarder = TelegramForwarder(api_id, api_hash, phone_number, language, config=config)
     
     while True:
         print("\n" + style_text(forwarder.translate("Choose an option:", language), 'title'))
@@ -489,5 +3008,5 @@ def edit_rule(rule, language, forwarder):
 
 # Start the event loop and run the main function
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
 
@@ -0,0 +1,45 @@
+# Helpers for the behaviour checks that run the forwarder end to end on
+# benchmarks/fake_client.py
+import asyncio
+import contextlib
+import time
+
+from telegram_forwarder import TelegramForwarder
+
+
+def make_config(tmp_path, **settings):
+    # No ledger, no rate limits and no config polling unless a check asks
+    config = {
+        'outbox': False,
+        'peer_cache_path': str(tmp_path / 'peers.json'),
+        'config_reload_interval': 0,
+        'rate_limits': {'global_per_second': 0, 'per_destination_per_second': 0},
+    }
+    config.update(settings)
+    return config
+
+
+async def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the forwarder")
+        await asyncio.sleep(0.01)
+
+
+@contextlib.asynccontextmanager
+async def running_forwarder(client, rules, config, **options):
+    # Yields the forwarder once its handlers are registered, and disconnects
+    # it (closing the pipeline and its ledger) on the way out
+    forwarder = TelegramForwarder(0, '', 'test', require_approval=False, config=config, client=client, **options)
+    task = asyncio.ensure_future(forwarder.forward_messages_to_channels(rules))
+    await wait_for(lambda: client.handlers or task.done())
+    if task.done():
+        task.result()
+    try:
+        yield forwarder
+    finally:
+        await client.drain()
+        await client.disconnect()
+        await task
+
@@ -0,0 +1,118 @@
+# Behaviour checks for the delivery ledger's catch-up: messages posted while
+# the forwarder was down are forwarded on the next start, a failed catch-up
+# is retried without moving the checkpoint past the gap, and a message that
+# arrives live while the history is being read is forwarded exactly once.
+#
+#   python -m pytest tests
+import asyncio
+
+from benchmarks.fake_client import FakeTelegramClient
+from telegram_forwarder import Outbox
+from tests.support import make_config, running_forwarder, wait_for
+
+SOURCE, DESTINATION = -1001, -1002
+RULES = [{'source_chat_id': SOURCE, 'destination_channels': [DESTINATION]}]
+
+
+class FailingCatchUpClient(FakeTelegramClient):
+    # The first look at the latest message of a chat fails, as a dropped
+    # connection would
+    failures = 1
+
+    async def get_messages(self, peer, ids=None, limit=None, **kwargs):
+        if limit == 1 and self.failures:
+            self.failures -= 1
+            raise ConnectionError("Connection to Telegram failed")
+        return await super().get_messages(peer, ids=ids, limit=limit, **kwargs)
+
+
+def forwarded_ids(client):
+    return sorted(request.source[1] for request in client.sent if request.chat_id == DESTINATION)
+
+
+def checkpoint(path):
+    async def read():
+        ledger = Outbox(str(path))
+        try:
+            return ledger.last_message_id(SOURCE)
+        finally:
+            await ledger.close()
+
+    return asyncio.run(read())
+
+
+def first_run(tmp_path, config):
+    # Forwards messages 1 and 2 live and stops, leaving a checkpoint at 2
+    async def run():
+        client = FakeTelegramClient(latency=0)
+        async with running_forwarder(client, RULES, config):
+            for message_id in (1, 2):
+                await client.inject(client.make_message(SOURCE, f"message {message_id}", id=message_id))
+            await client.drain()
+        assert forwarded_ids(client) == [1, 2]
+        return client.messages
+
+    return asyncio.run(run())
+
+
+def restart(client, messages, config, live=(), expected=(), settle=0.2):
+    # Starts again on a client that has the earlier messages and the ones
+    # posted while the forwarder was down, injects the live ones as soon as
+    # the handlers are registered, and waits for the expected sends and then
+    # `settle` seconds for any extra one
+    async def run():
+        client.messages = dict(messages)
+        async with running_forwarder(client, RULES, config):
+            for message_id in live:
+                await client.inject(client.messages[(SOURCE, message_id)])
+            await wait_for(lambda: len(client.sent) >= len(expected))
+            await asyncio.sleep(settle)
+        return forwarded_ids(client)
+
+    return asyncio.run(run())
+
+
+def posted_while_down(messages, message_ids, grouped_id=None):
+    client = FakeTelegramClient()
+    for message_id in message_ids:
+        messages[(SOURCE, message_id)] = client.make_message(
+            SOURCE, f"message {message_id}", grouped_id=grouped_id, id=message_id
+        )
+    return messages
+
+
+def ledger_config(tmp_path, **settings):
+    return make_config(tmp_path, outbox=True, outbox_path=str(tmp_path / 'outbox.db'), dedup=False, **settings)
+
+
+def test_restart_catches_up_on_missed_messages(tmp_path):
+    config = ledger_config(tmp_path)
+    messages = posted_while_down(first_run(tmp_path, config), (3, 4, 5))
+    assert checkpoint(tmp_path / 'outbox.db') == 2
+    forwarded = restart(FakeTelegramClient(latency=0), messages, config, expected=(3, 4, 5))
+    assert forwarded == [3, 4, 5]
+    assert checkpoint(tmp_path / 'outbox.db') == 5
+
+
+def test_failed_catch_up_is_retried(tmp_path):
+    config = ledger_config(tmp_path, catch_up_retry_delay=0.2)
+    messages = posted_while_down(first_run(tmp_path, config), (3, 4, 5, 6))
+    client = FailingCatchUpClient(latency=0)
+    forwarded = restart(client, messages, config, live=(6,), expected=(3, 4, 5, 6))
+    assert client.failures == 0
+    assert forwarded == [3, 4, 5, 6]
+    assert checkpoint(tmp_path / 'outbox.db') == 6
+
+
+def test_live_message_read_by_the_catch_up_is_forwarded_once(tmp_path):
+    # The album 5-6 is already in the history when the catch-up starts, and
+    # arrives live at the same time; it is still being buffered (without a
+    # ledger entry) when the catch-up gets to it
+    config = ledger_config(tmp_path)
+    messages = posted_while_down(first_run(tmp_path, config), (3, 4))
+    messages = posted_while_down(messages, (5, 6), grouped_id=1)
+    # Long enough for the album buffer to flush
+    forwarded = restart(FakeTelegramClient(latency=0.05), messages, config, live=(5, 6), expected=(3, 4, 5),
+                        settle=1.0)
+    assert forwarded == [3, 4, 5]
+    assert checkpoint(tmp_path / 'outbox.db') == 6
@@ -0,0 +1,54 @@
+# Behaviour checks for duplicate content: a post cross-posted by several
+# sources reaches a destination once, while a source repeating itself is
+# forwarded every time.
+#
+#   python -m pytest tests
+import asyncio
+
+from benchmarks.fake_client import FakeTelegramClient
+from tests.support import make_config, running_forwarder
+
+FIRST, SECOND, DESTINATION = -1001, -1002, -1003
+RULES = [
+    {'source_chat_id': FIRST, 'destination_channels': [DESTINATION]},
+    {'source_chat_id': SECOND, 'destination_channels': [DESTINATION]},
+]
+
+
+def forward(tmp_path, posts):
+    # posts are (source, text, photo_id) in the order they are posted; returns
+    # the source messages forwarded to the destination and the skip count
+    async def run():
+        client = FakeTelegramClient(latency=0)
+        async with running_forwarder(client, RULES, make_config(tmp_path)) as forwarder:
+            for source, text, photo_id in posts:
+                media = client.make_photo(photo_id) if photo_id else None
+                await client.inject(client.make_message(source, text, media=media))
+                await client.drain()
+        skipped = forwarder.metrics.totals().get('duplicates_skipped_total', 0)
+        return [request.source for request in client.sent if request.chat_id == DESTINATION], skipped
+
+    return asyncio.run(run())
+
+
+def test_a_source_repeating_itself_is_forwarded(tmp_path):
+    forwarded, skipped = forward(tmp_path, [
+        (FIRST, "Good morning", None),
+        (FIRST, "Good morning", None),
+        (FIRST, "", 7),
+        (FIRST, "", 7),
+    ])
+    assert forwarded == [(FIRST, 1), (FIRST, 2), (FIRST, 3), (FIRST, 4)]
+    assert skipped == 0
+
+
+def test_content_cross_posted_by_another_source_is_skipped(tmp_path):
+    forwarded, skipped = forward(tmp_path, [
+        (FIRST, "Good morning", None),
+        (SECOND, "Good morning!", None),
+        (SECOND, "", 7),
+        (FIRST, "", 7),
+        (FIRST, "Good morning", None),
+    ])
+    assert forwarded == [(FIRST, 1), (SECOND, 3), (FIRST, 5)]
+    assert skipped == 2
@@ -0,0 +1,75 @@
+# Behaviour checks for the send scheduler under flood waits: the send that
+# hit the wait is retried once it is over, nothing is dropped, and the other
+# destinations keep receiving messages in the meantime.
+#
+#   python -m pytest tests
+import asyncio
+
+from telethon.errors import FloodWaitError
+
+from benchmarks.fake_client import FakeTelegramClient
+from tests.support import make_config, running_forwarder, wait_for
+
+SOURCE, FLOODED, OTHER = -1001, -1002, -1003
+RULES = [{'source_chat_id': SOURCE, 'destination_channels': [FLOODED, OTHER]}]
+
+
+class FloodedDestinationClient(FakeTelegramClient):
+    # The first send to FLOODED is answered with a flood wait of 2 seconds
+    flooded = False
+
+    async def _request(self, kind, peer, payload, source=None, count=1, ids=None, entities=None):
+        if self.chat_id(peer) == FLOODED and not self.flooded:
+            self.flooded = True
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=2)
+        return await super()._request(kind, peer, payload, source, count, ids, entities)
+
+
+def forwarded(client, dest_channel):
+    return [request.source[1] for request in client.sent if request.chat_id == dest_channel]
+
+
+def gauge(rendered, name):
+    for line in rendered.splitlines():
+        if line.startswith(f"telegram_forwarder_{name} "):
+            return float(line.split()[1])
+    return None
+
+
+def test_random_flood_waits_drop_nothing(tmp_path):
+    async def run():
+        client = FakeTelegramClient(latency=0, flood_rate=0.25, flood_seconds=1, seed=3)
+        async with running_forwarder(client, RULES, make_config(tmp_path, dedup=False)) as forwarder:
+            for i in range(8):
+                await client.inject(client.make_message(SOURCE, f"message {i}"))
+            await wait_for(lambda: len(client.sent) >= 16, timeout=30)
+            flood_waits = forwarder.metrics.totals()['flood_waits_total']
+        return client, flood_waits
+
+    client, flood_waits = asyncio.run(run())
+    assert client.flood_waits > 0
+    assert flood_waits == client.flood_waits
+    assert sorted(forwarded(client, FLOODED)) == list(range(1, 9))
+    assert sorted(forwarded(client, OTHER)) == list(range(1, 9))
+
+
+def test_flood_wait_does_not_hold_back_other_destinations(tmp_path):
+    async def run():
+        client = FloodedDestinationClient(latency=0.01)
+        async with running_forwarder(client, RULES, make_config(tmp_path, dedup=False)) as forwarder:
+            for i in range(5):
+                await client.inject(client.make_message(SOURCE, f"message {i}"))
+            await wait_for(lambda: len(forwarded(client, OTHER)) == 5, timeout=1.5)
+            during_wait = forwarder.metrics.render()
+            sent_during_wait = forwarded(client, FLOODED)
+            await wait_for(lambda: len(forwarded(client, FLOODED)) == 5)
+        return client, during_wait, sent_during_wait
+
+    client, during_wait, sent_during_wait = asyncio.run(run())
+    assert sent_during_wait == []
+    assert gauge(during_wait, 'blocked_destinations') == 1
+    assert gauge(during_wait, 'sends_parked') > 0
+    # The send that hit the wait goes out first once it is over
+    assert forwarded(client, FLOODED) == [1, 2, 3, 4, 5]
+    assert max(r.at for r in client.sent if r.chat_id == OTHER) < min(r.at for r in client.sent if r.chat_id == FLOODED)
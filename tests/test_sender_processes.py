@@ -0,0 +1,117 @@
+# Behaviour checks for sender processes, started with the spawn context as in
+# production and sending through benchmarks/fake_client.py: a send makes the
+# round trip, a full job queue holds the receiver back without dropping
+# work, and work pending on a sender process that dies fails instead of
+# hanging.
+#
+#   python -m pytest tests
+import asyncio
+import functools
+import time
+
+import pytest
+
+from benchmarks.fake_client import FakeTelegramClient
+from telegram_forwarder import SenderProcesses
+from tests.support import make_config, running_forwarder, wait_for
+
+SOURCE, DESTINATION = -1001, -1002
+ACCOUNT = {'phone_number': '+100', 'api_id': 1, 'api_hash': 'hash'}
+
+
+class CountingSenderProcesses(SenderProcesses):
+    # Counts the work items the job queues accepted
+    accepted = 0
+
+    def _put(self, sender, work):
+        super()._put(sender, work)
+        if work is not None:
+            self.accepted += 1
+
+
+def work_item(message_id):
+    return {
+        'source_chat_id': SOURCE, 'message_ids': [message_id], 'has_media': False, 'captions': [],
+        'native': True, 'scheduled_time': None, 'rule': {},
+    }
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    # Sender processes keep their peer cache in the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def test_forwarded_through_a_sender_process(tmp_path):
+    async def run():
+        config = make_config(tmp_path, sender_processes=True, accounts=[ACCOUNT])
+        rules = [{'source_chat_id': SOURCE, 'destination_channels': [DESTINATION]}]
+        client = FakeTelegramClient(latency=0)
+        async with running_forwarder(client, rules, config, client_factory=FakeTelegramClient) as forwarder:
+            await client.inject(client.make_message(SOURCE, "hello"))
+            await wait_for(lambda: forwarder.metrics.totals().get('messages_forwarded_total', 0) == 1, timeout=30)
+            senders = forwarder.senders.stats()
+        return client, forwarder.metrics.totals(), senders
+
+    client, totals, senders = asyncio.run(run())
+    # The receiving client sent nothing itself
+    assert client.sent == []
+    assert totals.get('messages_failed_total', 0) == 0
+    assert senders == {'+100': {'alive': True, 'in_flight': 0, 'sent': 1}}
+
+
+def test_full_job_queue_holds_the_receiver_back():
+    async def run():
+        config = {'sender_prefetch': 1, 'rate_limits': {'global_per_second': 0, 'per_destination_per_second': 0}}
+        senders = CountingSenderProcesses(
+            [ACCOUNT], config, [SOURCE, DESTINATION], functools.partial(FakeTelegramClient, latency=0.5),
+            queue_size=1
+        )
+        senders.start()
+        try:
+            submitted = [
+                asyncio.ensure_future(senders.submit(DESTINATION, work_item(message_id)))
+                for message_id in range(1, 6)
+            ]
+            await wait_for(lambda: senders.senders[0].sent >= 1, timeout=30)
+            accepted_while_busy = senders.accepted
+            results = await asyncio.gather(*submitted)
+        finally:
+            await senders.stop()
+        return accepted_while_busy, results
+
+    accepted_while_busy, results = asyncio.run(run())
+    # One send done, one in progress and one waiting in the queue, the rest
+    # held back
+    assert accepted_while_busy <= 3
+    assert [name for name, _ in results] == ['+100'] * 5
+    assert all(len(sent) == 1 for _, sent in results)
+
+
+def test_sender_process_dying_fails_its_pending_work():
+    async def run():
+        config = {'rate_limits': {'global_per_second': 0, 'per_destination_per_second': 0}}
+        senders = CountingSenderProcesses(
+            [ACCOUNT], config, [SOURCE, DESTINATION], functools.partial(FakeTelegramClient, latency=60)
+        )
+        senders.start()
+        sender = senders.senders[0]
+        try:
+            pending = asyncio.ensure_future(senders.submit(DESTINATION, work_item(1)))
+            # Queued (the queue writes from a thread of its own), then taken
+            # off the queue by the sender process, which is now sending
+            await wait_for(lambda: senders.accepted == 1)
+            await asyncio.sleep(0.2)
+            await wait_for(sender.jobs.empty, timeout=30)
+            sender.process.kill()
+            start = time.monotonic()
+            with pytest.raises(RuntimeError, match="exited"):
+                await pending
+            failed_after = time.monotonic() - start
+            with pytest.raises(RuntimeError, match="No sender process is running"):
+                await senders.submit(DESTINATION, work_item(2))
+        finally:
+            await senders.stop()
+        return failed_after
+
+    assert asyncio.run(run()) < 5
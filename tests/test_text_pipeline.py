@@ -0,0 +1,115 @@
+# Behaviour checks for TextPipeline: the text it produces and where the
+# entities end up, in UTF-16 code units as Telegram counts them.
+#
+#   python -m pytest tests
+import asyncio
+
+from telethon.tl.types import MessageEntityBold, MessageEntityItalic, MessageEntityTextUrl, MessageEntityUrl
+
+from benchmarks.fake_client import FakeTelegramClient
+from telegram_forwarder import TextPipeline, TelegramForwarder
+
+REMOVE_LINKS = {'remove_links': True}
+
+
+def covered(text, entity):
+    # The part of the text an entity applies to
+    units = text.encode('utf-16-le')
+    return units[2 * entity.offset:2 * (entity.offset + entity.length)].decode('utf-16-le')
+
+
+def utf16_offset(text, substring):
+    return len(text[:text.index(substring)].encode('utf-16-le')) // 2
+
+
+def test_link_before_an_entity():
+    text = "see https://example.com/a?b=1 and bold"
+    formatted = TextPipeline(REMOVE_LINKS).apply(text, [MessageEntityBold(text.index("bold"), 4)])
+    assert formatted.text == "see  and bold"
+    assert [covered(formatted.text, entity) for entity in formatted.entities] == ["bold"]
+
+
+def test_entity_spanning_a_removed_link():
+    text = "read https://example.com today, thanks"
+    start = text.index("read")
+    formatted = TextPipeline(REMOVE_LINKS).apply(text, [MessageEntityItalic(start, text.index(",") - start)])
+    assert formatted.text == "read  today, thanks"
+    assert [covered(formatted.text, entity) for entity in formatted.entities] == ["read  today"]
+
+
+def test_entity_inside_a_removed_link_is_dropped():
+    text = "go https://example.com/path now"
+    formatted = TextPipeline(REMOVE_LINKS).apply(text, [MessageEntityBold(text.index("example"), 7)])
+    assert formatted.text == "go  now"
+    assert formatted.entities == []
+
+
+def test_link_entities_are_dropped():
+    text = "hidden link and https://example.com"
+    entities = [MessageEntityTextUrl(0, 6, "https://example.com/x"), MessageEntityUrl(text.index("https"), 19),
+                MessageEntityBold(text.index("link"), 4)]
+    formatted = TextPipeline(REMOVE_LINKS).apply(text, entities)
+    assert formatted.text == "hidden link and"
+    assert [(type(entity), covered(formatted.text, entity)) for entity in formatted.entities] == [
+        (MessageEntityBold, "link")
+    ]
+
+
+def test_emoji_before_an_entity():
+    text = "🎉🎉 party https://example.com time"
+    entities = [MessageEntityBold(utf16_offset(text, "time"), 4), MessageEntityItalic(utf16_offset(text, "party"), 5)]
+    pipeline = TextPipeline({'remove_links': True, 'prefix': "📣 ", 'suffix': " ✅"})
+    formatted = pipeline.frame(pipeline.apply(text, entities))
+    assert formatted.text == "📣 🎉🎉 party  time ✅"
+    assert [covered(formatted.text, entity) for entity in formatted.entities] == ["time", "party"]
+
+
+def test_leading_whitespace():
+    text = "   \n hello world  "
+    entities = [MessageEntityBold(text.index("world"), 5), MessageEntityItalic(1, text.index("hello"))]
+    formatted = TextPipeline({}).apply(text, entities)
+    assert formatted.text == "hello world"
+    assert [covered(formatted.text, entity) for entity in formatted.entities] == ["world", "h"]
+
+
+def test_whitespace_only_entity_is_dropped():
+    formatted = TextPipeline({}).apply("  text", [MessageEntityBold(0, 2)])
+    assert formatted.text == "text"
+    assert formatted.entities == []
+
+
+def test_source_entities_are_not_modified():
+    text = "a https://example.com b"
+    bold = MessageEntityBold(text.index("b"), 1)
+    pipeline = TextPipeline({'remove_links': True, 'prefix': ">> "})
+    pipeline.frame(pipeline.apply(text, [bold]))
+    assert (bold.offset, bold.length) == (text.index("b"), 1)
+
+
+def test_forwarded_copy_through_the_fake_client(tmp_path):
+    async def forward():
+        client = FakeTelegramClient(latency=0)
+        config = {
+            'outbox': False,
+            'peer_cache_path': str(tmp_path / 'peers.json'),
+            'config_reload_interval': 0,
+            'rate_limits': {'global_per_second': 0, 'per_destination_per_second': 0},
+        }
+        rules = [{'source_chat_id': -1001, 'destination_channels': [-1002], 'remove_links': True, 'prefix': "🔔 "}]
+        forwarder = TelegramForwarder(0, '', 'test', require_approval=False, config=config, client=client)
+        task = asyncio.ensure_future(forwarder.forward_messages_to_channels(rules))
+        while not client.handlers:
+            await asyncio.sleep(0.01)
+        text = "  😀 news https://example.com here"
+        message = client.make_message(-1001, text, [MessageEntityBold(utf16_offset(text, "here"), 4)])
+        await client.inject(message)
+        await client.drain()
+        while not client.sent:
+            await asyncio.sleep(0.01)
+        await client.disconnect()
+        await task
+        return client.sent
+
+    sent = asyncio.run(forward())
+    assert [request.payload for request in sent] == ["🔔 😀 news  here"]
+    assert [covered(sent[0].payload, entity) for entity in sent[0].entities] == ["here"]